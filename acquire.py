@@ -15,11 +15,23 @@ Used with permission.
 # ENVIRONMENT
 # ===========
 
+import hashlib
+import json
 import os
+import shutil
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 
+DATA_PATH = 'data/'
+
+# parsed tables are cached here as one .npy file per dtype block, keyed by
+# the source file's path, size and modification time and the cache format
+CACHE_PATH = 'data/.cache/'
+CACHE_VERSION = 2
+
 # variables to use by selection of features from data dictionary:
 
 ONE_COLS = ['CASEID',
@@ -118,18 +130,228 @@ ELEVEN_COLS = ['CASEID',
                'BOTHDRUG',
                ]
 
+# files and columns read by get_data
+SURVEY_SPECS = [('data01.csv', ONE_COLS),
+                ('data02.csv', TWO_COLS),
+                ('data03.csv', THREE_COLS),
+                ('data04.csv', FOUR_COLS),
+                ('data05.csv', FIVE_COLS),
+                ('data06.csv', SIX_COLS),
+                ('data07.csv', SEVEN_COLS),
+                ('data11.csv', ELEVEN_COLS),
+                ]
+
+# survey answers are small integer codes; columns not listed here
+# usually fit in an int16 (codes top out at 9999). read_data widens
+# any column whose values do not fit the dtype asked for
+WIDE_COLS = {'CASEID': 'int32',
+             'M27HOW': 'int32',
+             }
+INT_DTYPES = ('int8', 'int16', 'int32', 'int64')
+
 # ===========
 # ACQUISITION
 # ===========
 
-def read_data(filename):
+def get_dtypes(columns):
+    '''
+    takes a list of column names and returns a dictionary of the
+    integer dtype expected to hold each column's codes
+    (read_data widens it if a column's values do not fit)
+    '''
+    return {col: WIDE_COLS.get(col, 'int16') for col in columns}
+
+
+def fit_dtypes(df, dtypes):
+    '''
+    takes a dataframe and a dictionary of column name to dtype and returns the
+    dictionary with every integer dtype widened, where needed, to the smallest
+    integer dtype that holds the column's actual minimum and maximum,
+    so casting never wraps values around; a column with missing values
+    (blank cells, read as float NaN) keeps its float dtype
+    '''
+    fitted = {}
+    for col, dtype in dtypes.items():
+        dtype = np.dtype(dtype)
+        values = df[col].to_numpy()
+        if dtype.kind != 'i' or values.dtype.kind not in 'iuf' or not len(values):
+            fitted[col] = dtype
+            continue
+        if values.dtype.kind == 'f' and np.isnan(values).any():
+            fitted[col] = values.dtype
+            continue
+        low, high = np.nanmin(values), np.nanmax(values)
+        for name in INT_DTYPES[INT_DTYPES.index(dtype.name):]:
+            info = np.iinfo(name)
+            if info.min <= low and high <= info.max:
+                dtype = np.dtype(name)
+                break
+        else:
+            raise OverflowError('{} values ({} to {}) do not fit in an int64'.format(col, low, high))
+        fitted[col] = dtype
+    return fitted
+
+
+def read_data(filename, columns=None, dtypes=None, use_cache=True):
     """
     Reads in a subset of the dataset: Chicago Women's
     Health Risk Study, 1995-1998 (ICPSR 3002)
 
+    columns: optional list of columns to return, in that order;
+    only these columns are parsed or loaded from the cache.
+    dtypes: optional dictionary of column name to dtype,
+    e.g. the output of get_dtypes(columns); an integer dtype too
+    small for a column's values is widened, and a column with blank
+    cells stays float (see fit_dtypes).
+
+    The first read of a file parses the csv and stores its columns
+    as binary .npy files (one per dtype) under CACHE_PATH; later reads
+    load those arrays directly as long as the csv is unchanged.
+    Pass use_cache=False to always parse the csv.
+
     """
-    path="data/"
-    return pd.read_csv(path + filename, low_memory=False)
+    filepath = DATA_PATH + filename
+    if dtypes is not None and columns is not None:
+        dtypes = {col: dtype for col, dtype in dtypes.items() if col in columns}
+    if not use_cache:
+        df = pd.read_csv(filepath, usecols=columns, low_memory=False)
+        if columns is not None:
+            df = df[columns]
+        return df.astype(fit_dtypes(df, dtypes), copy=False) if dtypes else df
+    cache_dir = get_cache_dir(filepath)
+    if os.path.isdir(cache_dir):
+        df = load_cache(cache_dir, columns)
+    else:
+        df = pd.read_csv(filepath, low_memory=False)
+        write_cache(df, cache_dir)
+        if columns is not None:
+            df = df[columns]
+    if dtypes:
+        df = df.astype(fit_dtypes(df, dtypes), copy=False)
+    return df
+
+
+def get_cache_dir(filepath):
+    '''
+    takes the path of a csv file and returns the cache directory for its
+    current version; the name changes whenever the path, size or mtime
+    (or CACHE_VERSION) does
+    '''
+    stat = os.stat(filepath)
+    key = '{}|{}|{}|{}'.format(os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns,
+                               CACHE_VERSION)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(CACHE_PATH, '{}-{}'.format(os.path.basename(filepath), digest))
+
+
+def write_cache(df, cache_dir):
+    '''
+    saves the dataframe to cache_dir as one .npy file per dtype, each a
+    (columns x rows) array like the blocks pandas keeps in memory, so a load
+    is one read per dtype rather than one per column;
+    replaces any stale cache of the same csv.
+    failures to write are ignored so a read-only data directory still works.
+    '''
+    tmp_dir = '{}.tmp{}'.format(cache_dir, os.getpid())
+    try:
+        os.makedirs(tmp_dir, exist_ok=True)
+        dtypes = df.dtypes.astype(str)
+        meta = {'columns': list(df.columns), 'blocks': []}
+        for i, dtype in enumerate(dict.fromkeys(dtypes)):
+            columns = list(df.columns[(dtypes == dtype).to_numpy()])
+            values = np.ascontiguousarray(df[columns].to_numpy().T)
+            filename = '{:02d}.npy'.format(i)
+            np.save(os.path.join(tmp_dir, filename), values, allow_pickle=(dtype == 'object'))
+            meta['blocks'].append({'file': filename, 'dtype': dtype, 'columns': columns})
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        prefix = cache_dir.rsplit('-', 1)[0] + '-'
+        for entry in os.listdir(CACHE_PATH):
+            stale = os.path.join(CACHE_PATH, entry)
+            if stale.startswith(prefix) and stale != tmp_dir:
+                shutil.rmtree(stale, ignore_errors=True)
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_cache(cache_dir, columns=None):
+    '''
+    rebuilds a dataframe from the .npy blocks stored in cache_dir;
+    if columns is given, only those columns are copied out of the
+    (memory-mapped) blocks that hold them
+    '''
+    with open(os.path.join(cache_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    if columns is None:
+        columns = meta['columns']
+    wanted = set(columns)
+    missing = [col for col in columns if col not in meta['columns']]
+    if missing:
+        raise KeyError('{} not in cached columns'.format(missing))
+    parts = []
+    for block in meta['blocks']:
+        rows = [i for i, col in enumerate(block['columns']) if col in wanted]
+        if not rows:
+            continue
+        path = os.path.join(cache_dir, block['file'])
+        if block['dtype'] == 'object':
+            values = np.load(path, allow_pickle=True)
+        else:
+            values = np.load(path, mmap_mode='r' if len(rows) < len(block['columns']) else None)
+        if len(rows) < len(block['columns']):
+            values = np.asarray(values[rows])
+        parts.append(pd.DataFrame(values.T, columns=[block['columns'][i] for i in rows],
+                                  copy=False))
+    if not parts:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(parts, axis=1) if len(parts) > 1 else parts[0]
+    return df if list(df.columns) == list(columns) else df[columns]
+
+
+def clear_cache():
+    '''
+    deletes every cached table under CACHE_PATH
+    '''
+    shutil.rmtree(CACHE_PATH, ignore_errors=True)
+
+
+def read_many(specs, max_workers=None, use_processes=False):
+    '''
+    takes a list of (filename, columns) pairs and reads them concurrently
+    with read_data, returning the dataframes in the same order.
+    max_workers: pool size (default chosen by concurrent.futures),
+    use_processes: use a process pool instead of a thread pool.
+    '''
+    pool_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with pool_class(max_workers=max_workers) as pool:
+        futures = [pool.submit(read_data, filename, columns, get_dtypes(columns))
+                   for filename, columns in specs]
+        return [future.result() for future in futures]
+
+
+def merge_all(frames, on='CASEID', how='inner'):
+    '''
+    joins a list of dataframes on the key column (on) in a single pass:
+    every frame is indexed on the key once and all of them are aligned
+    together, instead of building an intermediate frame per pairwise merge.
+    how: 'inner' (default) or 'outer'.
+    Falls back to chained merges when a key repeats within a frame
+    or non-key column names collide, as those need merge semantics.
+    '''
+    if how not in ('inner', 'outer'):
+        raise ValueError("how must be 'inner' or 'outer', got {!r}".format(how))
+    indexed = [df.set_index(on) for df in frames]
+    names = [col for df in indexed for col in df.columns]
+    if len(set(names)) < len(names) or not all(df.index.is_unique for df in indexed):
+        merged = frames[0]
+        for df in frames[1:]:
+            merged = merged.merge(right=df, on=on, how=how)
+        return merged
+    # outer joins come back sorted by key, as chained merges return them
+    merged = pd.concat(indexed, axis=1, join=how, sort=(how == 'outer'))
+    merged.index.name = on
+    return merged.reset_index()
 
 
 def join_data(filename1, filename2):
@@ -137,44 +359,25 @@ def join_data(filename1, filename2):
     Merges the two subsets into one dataset.
 
     """
-    df1 = read_data(filename1)
-    df2 = read_data(filename2)
-    return pd.merge(df1, df2, on='CASEID', how='inner')
+    return merge_all([read_data(filename1), read_data(filename2)])
 
 
-def get_data():
+def get_data(max_workers=None, use_processes=False):
     '''
     Reads in local csv files using read_data function and path 
     specified in .env and returns two pandas dataframes
     of merged data with selected columns specified above.
+    Only the selected columns are read, as small integer dtypes.
+    The files are read concurrently; see read_many for
+    max_workers and use_processes.
 
     '''
-    df1 = read_data('data01.csv')
-    df2 = read_data('data02.csv')
-    df3 = read_data('data03.csv')
-    df4 = read_data('data04.csv')
-    df5 = read_data('data05.csv')
-    df6 = read_data('data06.csv')
-    df7 = read_data('data07.csv')
-    df11 = read_data('data11.csv')
-
-    df1 = df1[ONE_COLS]
-    df2 = df2[TWO_COLS]
-    df3 = df3[THREE_COLS]
-    df4 = df4[FOUR_COLS]
-    df5 = df5[FIVE_COLS]
-    df7 = df7[SEVEN_COLS]
-
-    dfa = df1.merge(right=df2, on='CASEID')
-    dfa = dfa.merge(right=df3, on='CASEID')
-    dfa = dfa.merge(right=df4, on='CASEID')
-    dfa = dfa.merge(right=df5, on='CASEID')
-    dfa = dfa.merge(right=df7, on='CASEID')
-
-    df6 = df6[SIX_COLS]
-    df11 = df11[ELEVEN_COLS]
-
-    dfb = df6.merge(right=df11, on='CASEID')
+    df1, df2, df3, df4, df5, df6, df7, df11 = read_many(SURVEY_SPECS,
+                                                        max_workers=max_workers,
+                                                        use_processes=use_processes)
+
+    dfa = merge_all([df1, df2, df3, df4, df5, df7])
+    dfb = merge_all([df6, df11])
 
     return dfa, dfb
 
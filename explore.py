@@ -15,78 +15,373 @@ Used with permission.
 # ENVIRONMENT
 # ===========
 
-import scipy.stats as stats
-import matplotlib.pyplot as plt
+import html
+import inspect
+import os
+import re
+import sys
+
+import numpy as np
 import pandas as pd
-import seaborn as sns
 import operator
+from concurrent.futures import ProcessPoolExecutor
+
+# scipy, matplotlib and seaborn are imported inside the functions that use
+# them, so importing this module stays cheap for workers that only need a few
+
 
+def get_t_tests(df, continuous_vars, target, equal_var=True):
+    '''
+    Runs t-tests between the two groups of target (1 vs 0) for every column in
+    continuous_vars at once: the dataframe is split by target a single time and
+    the statistics are computed column-wise over the whole feature matrix.
+    equal_var: Student's t-test if True (default), Welch's if False.
 
-def get_significant_t_tests(df, continuous_vars, target):
+    Returns a dataframe with one row per feature: feature, t_stat, p_value
+    '''
+    import scipy.stats as stats
+    continuous_vars = list(continuous_vars)
+    labels = df[target].to_numpy()
+    values = df[continuous_vars].to_numpy(dtype=float)
+    tstat, pval = stats.ttest_ind(values[labels == 1], values[labels == 0],
+                                  axis=0, equal_var=equal_var)
+    return pd.DataFrame({'feature': continuous_vars,
+                         't_stat': np.atleast_1d(tstat),
+                         'p_value': np.atleast_1d(pval)})
+
+
+def get_significant_t_tests(df, continuous_vars, target, alpha=0.05, equal_var=True, show=True,
+                            permutations=None, random_state=None, n_jobs=None):
     '''
     Runs t-tests between two groups from 
     df: a dataframe and 
     continuous_vars: a list of column names.
     against
     target: a comparative variable from df to test between
+    (see get_t_tests; alpha is the significance level, default 0.05)
+    permutations: if given, p-values come from that many label permutations
+    (see get_permutation_t_tests, with random_state and n_jobs)
 
-    If test results are noteworthy due to the t-statistic and p-value, results are printed
+    If show, the t-statistic and p-value of every feature are printed
 
     Returns a list of perceived significant features and a dictionary with variable name and t-statistic
     '''
+    if permutations:
+        results = get_permutation_t_tests(df, continuous_vars, target, permutations, equal_var,
+                                          random_state=random_state, n_jobs=n_jobs)
+    else:
+        results = get_t_tests(df, continuous_vars, target, equal_var=equal_var)
     some_feats = []
     some_dict = {}
-    train_df = df
-    buildstr1 = r'train_df[train_df.' + target + r' == 1].'
-    buildstr2 = r'train_df[train_df.' + target + r' == 0].'
-    for feat in continuous_vars:
-        affirmative = buildstr1 + feat
-        negative = buildstr2 + feat
-        tstat, pval = stats.ttest_ind(eval(affirmative), eval(negative))
-        if pval < 0.05:
+    for feat, tstat, pval in results.itertuples(index=False):
+        if show:
             print(f'Feature analyzed: {feat}')
             print(
                 'Our t-statistic is {:.4} and the p-value is {:.10}'.format(tstat, pval))
             print('----------')
+        if pval < alpha:
             some_feats.append(feat)
             some_dict[feat] = tstat
-        else:
-            print(f'Feature analyzed: {feat}')
-            print(
-                'Our t-statistic is {:.4} and the p-value is {:.10}'.format(tstat, pval))
-            print('----------')
+    return some_feats, some_dict
 
 
-    return some_feats, some_dict
+def get_contingency_tables(df, features, target):
+    '''
+    Builds the feature x target contingency table of every feature in one pass:
+    each column is integer-coded, the codes of all features are offset into
+    a single range and counted together with one np.bincount.
+    Rows where the feature or the target is null are left out, as in pd.crosstab.
+
+    Returns a list of 2-d count arrays, one per feature
+    '''
+    features = list(features)
+    target_codes, target_levels = pd.factorize(df[target], sort=True)
+    num_targets = len(target_levels)
+    codes = []
+    sizes = []
+    for feat in features:
+        feat_codes, feat_levels = pd.factorize(df[feat], sort=True)
+        codes.append(feat_codes)
+        sizes.append(len(feat_levels))
+    offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    codes = np.column_stack(codes).astype(np.int64)
+    valid = (codes >= 0) & (target_codes >= 0)[:, None]
+    cells = (codes + offsets[:-1]) * num_targets + target_codes[:, None]
+    counts = np.bincount(cells[valid], minlength=offsets[-1] * num_targets)
+    counts = counts.reshape(offsets[-1], num_targets)
+    tables = []
+    for start, stop in zip(offsets[:-1], offsets[1:]):
+        tbl = counts[start:stop]
+        tables.append(tbl[tbl.sum(axis=1) > 0][:, tbl.sum(axis=0) > 0])
+    return tables
+
+
+def get_chi_squared_table(df, features, target, n_jobs=None):
+    '''
+    Runs chi-squared tests of independence between every feature and target
+    (with Yates' correction on 2x2 tables, like stats.chi2_contingency)
+    from contingency tables built by get_contingency_tables.
+    cramers_v is computed from the uncorrected statistic, like
+    stats.contingency.association(method='cramer'); the correction only
+    enters chi2 and p_value.
+    n_jobs: if more than 1, the features are split across that many worker processes.
+
+    Returns a dataframe with one row per feature:
+    feature, chi2, dof, p_value, cramers_v, n
+    '''
+    import scipy.stats as stats
+    features = list(features)
+    if n_jobs is not None and n_jobs > 1 and len(features) > 1:
+        chunks = [features[i::n_jobs] for i in range(n_jobs)]
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(get_chi_squared_table, df[chunk + [target]], chunk, target)
+                       for chunk in chunks if chunk]
+            results = pd.concat([future.result() for future in futures])
+        return results.set_index('feature').loc[features].reset_index()
+    stat = np.zeros(len(features))
+    uncorrected = np.zeros(len(features))
+    dof = np.zeros(len(features), dtype=np.int64)
+    n = np.zeros(len(features), dtype=np.int64)
+    min_dim = np.zeros(len(features), dtype=np.int64)
+    for i, tbl in enumerate(get_contingency_tables(df, features, target)):
+        n[i] = tbl.sum()
+        min_dim[i] = min(tbl.shape)
+        dof[i] = max(tbl.shape[0] - 1, 0) * max(tbl.shape[1] - 1, 0)
+        if dof[i] == 0:
+            continue
+        observed = tbl.astype(float)
+        expected = np.outer(observed.sum(axis=1), observed.sum(axis=0)) / n[i]
+        uncorrected[i] = ((observed - expected) ** 2 / expected).sum()
+        if dof[i] == 1:
+            diff = expected - observed
+            observed = observed + np.sign(diff) * np.minimum(0.5, np.abs(diff))
+        stat[i] = ((observed - expected) ** 2 / expected).sum()
+    pval = np.where(dof > 0, stats.chi2.sf(stat, np.maximum(dof, 1)), 1.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cramers_v = np.sqrt(uncorrected / (n * (min_dim - 1)))
+    cramers_v = np.where(dof > 0, cramers_v, 0.0)
+    return pd.DataFrame({'feature': features,
+                         'chi2': stat,
+                         'dof': dof,
+                         'p_value': pval,
+                         'cramers_v': cramers_v,
+                         'n': n})
+
+
+def get_permutation_batches(n_permutations, batch_size=200, random_state=None):
+    '''
+    Splits n_permutations into batches of at most batch_size, each with its own
+    seed spawned from random_state, so results do not depend on how the
+    batches are spread over workers
+
+    Returns a list of (size, seed) pairs
+    '''
+    num_batches = max(1, -(-n_permutations // batch_size))
+    seeds = np.random.SeedSequence(random_state).spawn(num_batches)
+    sizes = [batch_size] * (num_batches - 1)
+    sizes.append(n_permutations - batch_size * (num_batches - 1))
+    return list(zip(sizes, seeds))
+
+
+def run_permutation_batches(func, args, batches, n_jobs=None):
+    '''
+    Calls func(*args, size, seed) for every batch, across n_jobs worker
+    processes if n_jobs is more than 1, and returns the summed results
+    '''
+    if n_jobs is not None and n_jobs > 1 and len(batches) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(func, *args, size, seed) for size, seed in batches]
+            return sum(future.result() for future in futures)
+    return sum(func(*args, size, seed) for size, seed in batches)
+
+
+def permute_labels(labels, size, seed):
+    '''
+    returns a (size, len(labels)) array whose rows are random permutations of labels
+    '''
+    rng = np.random.default_rng(seed)
+    return rng.permuted(np.tile(labels, (size, 1)), axis=1)
+
+
+def t_stats_for_groups(in_group, values, equal_var=True):
+    '''
+    Computes t-statistics for every row of in_group (a (b, n) 0/1 array marking
+    the target == 1 group, the rest being target == 0) against every column
+    of values (an (n, k) array) with two matrix products
+
+    Returns a (b, k) array
+    '''
+    values = values - values.mean(axis=0)
+    n1 = in_group.sum(axis=1)[:, None]
+    n0 = in_group.shape[1] - n1
+    sum1 = in_group @ values
+    sq1 = in_group @ (values ** 2)
+    sum0 = values.sum(axis=0) - sum1
+    sq0 = (values ** 2).sum(axis=0) - sq1
+    mean1 = sum1 / n1
+    mean0 = sum0 / n0
+    var1 = (sq1 - n1 * mean1 ** 2) / (n1 - 1)
+    var0 = (sq0 - n0 * mean0 ** 2) / (n0 - 1)
+    if equal_var:
+        pooled = ((n1 - 1) * var1 + (n0 - 1) * var0) / (n1 + n0 - 2)
+        denom = np.sqrt(pooled * (1 / n1 + 1 / n0))
+    else:
+        denom = np.sqrt(var1 / n1 + var0 / n0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (mean1 - mean0) / denom
+
+
+def count_t_exceedances(values, labels, observed, equal_var, size, seed):
+    '''
+    counts, per feature, the label permutations whose |t| reaches the observed |t|
+    '''
+    in_group = permute_labels(labels, size, seed).astype(float)
+    tstat = np.abs(t_stats_for_groups(in_group, values, equal_var))
+    return (tstat >= np.abs(observed) - 1e-12).sum(axis=0)
 
 
-def get_chi_squared(df, features, target):
+def get_permutation_t_tests(df, continuous_vars, target, n_permutations=1000, equal_var=True,
+                            random_state=None, n_jobs=None, batch_size=200):
+    '''
+    Permutation version of get_t_tests: the target labels (1 vs 0) are shuffled
+    n_permutations times and the t-statistics of all features are recomputed for
+    each batch of permutations at once (see t_stats_for_groups).
+    The p-value is (1 + permutations with |t| >= observed |t|) / (1 + n_permutations),
+    or NaN where the observed t is NaN (e.g. a constant feature), as in get_t_tests.
+    random_state: seed for reproducible results (independent of n_jobs),
+    n_jobs: number of worker processes for the permutation batches.
+    continuous_vars must not contain nulls.
+
+    Returns a dataframe with one row per feature: feature, t_stat, p_value
+    '''
+    continuous_vars = list(continuous_vars)
+    subset = df[df[target].isin([0, 1])]
+    values = subset[continuous_vars].to_numpy(dtype=float)
+    if np.isnan(values).any():
+        raise ValueError('continuous_vars contain nulls; drop or impute them first')
+    labels = (subset[target].to_numpy() == 1).astype(np.int8)
+    observed = t_stats_for_groups(labels[None, :].astype(float), values, equal_var)[0]
+    batches = get_permutation_batches(n_permutations, batch_size, random_state)
+    exceed = run_permutation_batches(count_t_exceedances,
+                                     (values, labels, observed, equal_var),
+                                     batches, n_jobs)
+    # a constant feature has no t-statistic (NaN), and so no p-value
+    p_value = np.where(np.isnan(observed), np.nan, (1 + exceed) / (1 + n_permutations))
+    return pd.DataFrame({'feature': continuous_vars,
+                         't_stat': observed,
+                         'p_value': p_value})
+
+
+def chi2_from_counts(counts, offsets, yates):
+    '''
+    Computes chi-squared statistics from a (b, num_targets, num_levels) array of
+    counts, where the levels of feature j occupy columns offsets[j]:offsets[j + 1];
+    yates: boolean array marking the features to apply Yates' correction to
+
+    Returns a (b, num_features) array
+    '''
+    sizes = np.diff(offsets)
+    feat_of_col = np.repeat(np.arange(len(sizes)), sizes)
+    col_sums = counts.sum(axis=1)
+    target_sums = np.add.reduceat(counts, offsets[:-1], axis=2)
+    n = target_sums.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = (col_sums[:, None, :] * target_sums[:, :, feat_of_col]
+                    / n[:, None, feat_of_col])
+        diff = np.abs(counts - expected)
+        diff = np.where(yates[feat_of_col], diff - np.minimum(0.5, diff), diff)
+        terms = np.where(expected > 0, diff ** 2 / expected, 0.0)
+    return np.add.reduceat(terms.sum(axis=1), offsets[:-1], axis=1)
+
+
+def count_chi2_exceedances(levels, target_codes, num_targets, offsets, yates,
+                           observed, size, seed):
+    '''
+    counts, per feature, the target permutations whose chi2 reaches the observed chi2
+    '''
+    permuted = permute_labels(target_codes, size, seed)
+    counts = np.stack([(permuted == t).astype(float) @ levels
+                       for t in range(num_targets)], axis=1)
+    stat = chi2_from_counts(counts, offsets, yates)
+    return (stat >= observed - 1e-9).sum(axis=0)
+
+
+def get_permutation_chi_squared_table(df, features, target, n_permutations=1000,
+                                      random_state=None, n_jobs=None, batch_size=200):
+    '''
+    Permutation version of get_chi_squared_table: the target is shuffled
+    n_permutations times and the contingency tables of all features are rebuilt
+    for each batch of permutations with one matrix product per target level.
+    The p-value is (1 + permutations with chi2 >= observed chi2) / (1 + n_permutations).
+    random_state: seed for reproducible results (independent of n_jobs),
+    n_jobs: number of worker processes for the permutation batches.
+
+    Returns a dataframe with one row per feature: feature, chi2, dof, p_value, n
+    '''
+    features = list(features)
+    subset = df[df[target].notna()]
+    target_codes, target_levels = pd.factorize(subset[target], sort=True)
+    sizes = []
+    codes = []
+    for feat in features:
+        feat_codes, feat_levels = pd.factorize(subset[feat], sort=True)
+        if len(feat_levels) == 0:
+            raise ValueError('{} has no non-null values'.format(feat))
+        codes.append(feat_codes)
+        sizes.append(len(feat_levels))
+    offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    # one-hot matrix of every feature level; rows with a null feature stay zero
+    levels = np.zeros((len(subset), offsets[-1]))
+    for start, feat_codes in zip(offsets[:-1], codes):
+        valid = feat_codes >= 0
+        levels[np.flatnonzero(valid), start + feat_codes[valid]] = 1.0
+    observed_table = get_chi_squared_table(subset, features, target)
+    yates = observed_table['dof'].to_numpy() == 1
+    counts = np.stack([(target_codes == t).astype(float) @ levels
+                       for t in range(len(target_levels))])[None, :, :]
+    observed = chi2_from_counts(counts, offsets, yates)[0]
+    batches = get_permutation_batches(n_permutations, batch_size, random_state)
+    exceed = run_permutation_batches(count_chi2_exceedances,
+                                     (levels, target_codes, len(target_levels),
+                                      offsets, yates, observed),
+                                     batches, n_jobs)
+    p_value = np.where(observed_table['dof'] > 0, (1 + exceed) / (1 + n_permutations), 1.0)
+    return pd.DataFrame({'feature': features,
+                         'chi2': observed,
+                         'dof': observed_table['dof'].to_numpy(),
+                         'p_value': p_value,
+                         'n': observed_table['n'].to_numpy()})
+
+
+def get_chi_squared(df, features, target, alpha=0.05, n_jobs=None, show=True,
+                    permutations=None, random_state=None):
     '''
     Runs chi-squared test between two categorical variables from 
     df: a dataframe and
     features: a list of columns
     target: a variable name to compare to the cycled features list
+    (see get_chi_squared_table; alpha is the significance level, default 0.05)
+    permutations: if given, p-values come from that many target permutations
+    (see get_permutation_chi_squared_table, with random_state and n_jobs)
 
-    Results are printed depending on perceived significance
+    If show, significant features are printed
     Returns a list of significant features as well as a dictionary with chi-stat
      '''
-    train_df = df
+    if permutations:
+        results = get_permutation_chi_squared_table(df, features, target, permutations,
+                                                    random_state=random_state, n_jobs=n_jobs)
+    else:
+        results = get_chi_squared_table(df, features, target, n_jobs=n_jobs)
     sig_feats = []
     sig_dict = {}
-    for feat in features:
-        tbl = pd.crosstab(train_df[feat], train_df[target])
-        stat, p, dof, expected = stats.chi2_contingency(tbl)
-        prob = .95
-        critical = stats.chi2.ppf(prob, dof)
-        if abs(stat) >= critical:
-            if p < 0.05:
-                sig_dict[feat] = abs(stat)
+    for feat, stat, p in results[['feature', 'chi2', 'p_value']].itertuples(index=False):
+        if p < alpha:
+            sig_dict[feat] = abs(stat)
+            if show:
                 print(feat)
                 print('Dependent (reject H0)')
                 print('-----------------------')
-                sig_feats.append(feat)
-        else:
-            pass
+            sig_feats.append(feat)
     return sig_feats, sig_dict
 
 
@@ -94,12 +389,7 @@ def sort_sigs(a_dict):
     '''
     takes in a dictionary (a_dict) and sorts based on values associated with each key
     '''
-    val_list = []
-    for key in a_dict:
-        val_list.append(a_dict[key])
-        sorted_vals = sorted(
-            a_dict.items(), key=operator.itemgetter(1), reverse=True)
-        return sorted_vals
+    return sorted(a_dict.items(), key=operator.itemgetter(1), reverse=True)
 
 
 def combine_significants(dict1, dict2):
@@ -111,46 +401,243 @@ def combine_significants(dict1, dict2):
     first element of each of the argument lists
     returns a new list of all features
     '''
-    list1 = sort_sigs(dict1)
-    list2 = sort_sigs(dict2)
-    new_list = []
-    for item in list1:
-        new_list.append(item[0])
-    for item in list2:
-        if item not in(new_list):
-            new_list.append(item[0])
+    new_list = [feat for feat, stat in sort_sigs(dict1)]
+    seen = set(new_list)
+    for feat, stat in sort_sigs(dict2):
+        if feat not in seen:
+            new_list.append(feat)
+            seen.add(feat)
     return new_list
 
 
-def make_violin1(df, features):
+def adjust_p_values(p_values, method='fdr_bh'):
+    '''
+    Corrects an array of p-values for multiple testing
+    method: 'fdr_bh' (Benjamini-Hochberg false discovery rate, default),
+    'bonferroni', or None for no correction
+
+    Returns the adjusted p-values in the original order
+    '''
+    p_values = np.asarray(p_values, dtype=float)
+    m = len(p_values)
+    if method is None or m == 0:
+        return p_values.copy()
+    if method == 'bonferroni':
+        return np.minimum(p_values * m, 1.0)
+    if method == 'fdr_bh':
+        order = np.argsort(p_values)
+        scaled = p_values[order] * m / np.arange(1, m + 1)
+        adjusted = np.empty(m)
+        adjusted[order] = np.minimum(np.minimum.accumulate(scaled[::-1])[::-1], 1.0)
+        return adjusted
+    raise ValueError("method must be 'fdr_bh', 'bonferroni' or None, got {!r}".format(method))
+
+
+def rank_features(t_results=None, chi_results=None, method='fdr_bh', alpha=0.05, top_k=None):
+    '''
+    Merges screening results into one ranking of features:
+    t_results: a dataframe from get_t_tests and
+    chi_results: a dataframe from get_chi_squared_table
+    p-values of all tests are corrected together (see adjust_p_values);
+    a feature tested more than once keeps its smallest adjusted p-value.
+    Features are ranked by adjusted p-value, then by the size of the statistic.
+    top_k: keep only the k best ranked features
+
+    Returns a dataframe with one row per feature:
+    feature, test, statistic, p_value, p_adjusted, significant
+    '''
+    tables = []
+    if t_results is not None:
+        tables.append(pd.DataFrame({'feature': t_results['feature'],
+                                    'test': 't',
+                                    'statistic': t_results['t_stat'],
+                                    'p_value': t_results['p_value']}))
+    if chi_results is not None:
+        tables.append(pd.DataFrame({'feature': chi_results['feature'],
+                                    'test': 'chi2',
+                                    'statistic': chi_results['chi2'],
+                                    'p_value': chi_results['p_value']}))
+    if not tables:
+        raise ValueError('pass t_results, chi_results or both')
+    results = pd.concat(tables, ignore_index=True)
+    p_values = results['p_value'].fillna(1.0).to_numpy()
+    results['p_adjusted'] = adjust_p_values(p_values, method)
+    order = np.lexsort((-results['statistic'].abs().fillna(0).to_numpy(),
+                        results['p_adjusted'].to_numpy()))
+    results = results.iloc[order].drop_duplicates(subset='feature')
+    if top_k is not None:
+        results = results.head(top_k)
+    results['significant'] = results['p_adjusted'] < alpha
+    return results.reset_index(drop=True)
+
+
+# ========
+# PLOTTING
+# ========
+
+# the plotting helpers below show each figure by default; given out_dir they
+# save it there instead (fmt 'png' or 'svg'), close it and return the file paths
+
+
+def use_headless():
+    '''
+    switches matplotlib to the non-interactive Agg backend,
+    for rendering figures to files in scripts and worker processes
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def finish_figure(fig, out_dir=None, name='figure', fmt='png'):
+    '''
+    shows the figure, or if out_dir is given saves it there as name.fmt
+    and closes it; returns the list of saved paths
+    '''
+    import matplotlib.pyplot as plt
+    if out_dir is None:
+        plt.show()
+        return []
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, '{}.{}'.format(re.sub(r'[^\w.-]+', '_', name), fmt))
+    fig.savefig(path, format=fmt, bbox_inches='tight')
+    plt.close(fig)
+    return [path]
+
+
+def make_violin1(df, features, out_dir=None, fmt='png'):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    paths = []
     for feature in features:
+        fig = plt.figure()
         sns.violinplot(y=df[feature])
-        plt.show()
+        paths += finish_figure(fig, out_dir, f'violin1_{feature}', fmt)
+    return paths
 
 
-def make_violin2(df, target, features):
+def make_violin2(df, target, features, out_dir=None, fmt='png'):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    paths = []
     for feature in features:
+        fig = plt.figure()
         sns.violinplot(data=df, x=target, y=feature)
-        plt.show()
+        paths += finish_figure(fig, out_dir, f'violin2_{target}_{feature}', fmt)
+    return paths
 
 
-def make_violin3(df, features, continuous, target):
+def make_violin3(df, features, continuous, target, out_dir=None, fmt='png'):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    paths = []
     for feature in features:
+        fig = plt.figure()
         sns.violinplot(data=df, x=feature, y=continuous, hue=target, split=True)
-        plt.show()
+        paths += finish_figure(fig, out_dir, f'violin3_{feature}_{continuous}_{target}', fmt)
+    return paths
 
 
 
-def swarrrm(df, cat, num_vars):
+def stratified_sample(df, cat, max_points, random_state=0):
+    '''
+    returns at most about max_points rows of df, sampled within each
+    category of cat in proportion to its size (every category keeps at least
+    one row), in the original row order; df itself if it is already small enough
+    '''
+    if max_points is None or len(df) <= max_points:
+        return df
+    rng = np.random.default_rng(random_state)
+    codes = pd.factorize(df[cat])[0]
+    keep = []
+    for code in np.unique(codes):
+        rows = np.flatnonzero(codes == code)
+        size = max(1, int(round(max_points * len(rows) / len(df))))
+        keep.append(rng.choice(rows, size=min(size, len(rows)), replace=False))
+    return df.iloc[np.sort(np.concatenate(keep))]
+
+
+def swarrrm(df, cat, num_vars, max_points=None, random_state=0, out_dir=None, fmt='png'):
     '''
     creates a series of swarm plots from a dataframe (df)
      using a categorical variable (cat) 
      and a list of continuous ones (num_vars)
+     max_points: caps the points drawn per plot with stratified_sample,
+     as swarm layout gets slow with many rows
      '''
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    paths = []
     for var in num_vars:
-        plt.figure(figsize=(10, 6))
-        sns.swarmplot(data=df, x=cat, y=var)
-        plt.show()
+        sample = stratified_sample(df[[cat, var]], cat, max_points, random_state)
+        fig = plt.figure(figsize=(10, 6))
+        sns.swarmplot(data=sample, x=cat, y=var)
+        paths += finish_figure(fig, out_dir, f'swarm_{cat}_{var}', fmt)
+    return paths
+
+
+def get_density_grid(df, cat, feature, grid_size=200, cut=3):
+    '''
+    Estimates the density of feature within each category of cat on one shared grid
+    of grid_size points, as a binned Gaussian KDE (Scott's rule bandwidth):
+    the values are counted into the grid with np.bincount and smoothed with
+    np.convolve, so the cost beyond one counting pass does not depend on row count.
+    cut: how many bandwidths the grid extends past the data.
+
+    Returns the grid and a dictionary of category to density on the grid
+    '''
+    data = df[[cat, feature]].dropna()
+    values = data[feature].to_numpy(dtype=float)
+    groups = {level: values[(data[cat] == level).to_numpy()]
+              for level in np.sort(data[cat].unique())}
+    bandwidths = {}
+    for level, group in groups.items():
+        spread = group.std(ddof=1) if len(group) > 1 else 0.0
+        bandwidths[level] = spread * len(group) ** (-1 / 5)
+    pad = cut * max(bandwidths.values(), default=0.0)
+    low, high = values.min() - pad, values.max() + pad
+    if high == low:
+        low, high = low - 0.5, high + 0.5
+    grid = np.linspace(low, high, grid_size)
+    step = grid[1] - grid[0]
+    densities = {}
+    for level, group in groups.items():
+        bins = np.clip(np.rint((group - low) / step).astype(np.int64), 0, grid_size - 1)
+        counts = np.bincount(bins, minlength=grid_size).astype(float)
+        sigma = max(bandwidths[level] / step, 0.5)
+        half = int(np.ceil(4 * sigma))
+        kernel = np.exp(-0.5 * (np.arange(-half, half + 1) / sigma) ** 2)
+        # the kernel can be wider than the grid for small categories, so take
+        # the grid's own span of the full convolution rather than mode='same'
+        density = np.convolve(counts, kernel / kernel.sum())[half:half + grid_size]
+        densities[level] = density / (density.sum() * step)
+    return grid, densities
+
+
+def make_violin_fast(df, target, features, grid_size=200, out_dir=None, fmt='png'):
+    '''
+    fast stand-in for make_violin2: draws one violin per category of target
+    from densities precomputed by get_density_grid, with a tick at the median,
+    instead of having seaborn fit a KDE on every row
+    '''
+    import matplotlib.pyplot as plt
+    paths = []
+    for feature in features:
+        grid, densities = get_density_grid(df, target, feature, grid_size)
+        fig, ax = plt.subplots()
+        try:
+            for pos, (level, density) in enumerate(densities.items()):
+                half_width = 0.4 * density / density.max() if density.max() > 0 else density
+                ax.fill_betweenx(grid, pos - half_width, pos + half_width, alpha=0.7)
+                median = df.loc[df[target] == level, feature].median()
+                ax.plot([pos - 0.1, pos + 0.1], [median, median], color='black')
+            ax.set_xticks(range(len(densities)))
+            ax.set_xticklabels([str(level) for level in densities])
+            ax.set_xlabel(target)
+            ax.set_ylabel(feature)
+            paths += finish_figure(fig, out_dir, f'violin_fast_{target}_{feature}', fmt)
+        finally:
+            plt.close(fig)
+    return paths
 
 
 def make_rel(df, x, y, hue):
@@ -158,38 +645,118 @@ def make_rel(df, x, y, hue):
     creates a relplot from a dataframe df using 
     two continuous (x, y)
     and one categorical (hue) variable
+    returns the seaborn FacetGrid
     '''
-    sns.relplot(x=x, y=y, hue=hue, data=df)
+    import seaborn as sns
+    return sns.relplot(x=x, y=y, hue=hue, data=df)
 
 
-def make_rels(df, feat1, feat2, features):
+def make_rels(df, feat1, feat2, features, out_dir=None, fmt='png'):
     '''
     takes in a a dataframe df,
     feat1 and fat2:  two feature variable names, and 
     features: a list of other features for comparative relplots
     '''
+    paths = []
     for feat in features:
-        make_rel(df, feat1, feat2, feat)
-        plt.show()
+        grid = make_rel(df, feat1, feat2, feat)
+        paths += finish_figure(grid.figure, out_dir, f'rel_{feat1}_{feat2}_{feat}', fmt)
+    return paths
 
 
-def make_bars(df, features):
+def make_bars(df, features, out_dir=None, fmt='png'):
     '''
     creates bar plots based on
     df: a pandas dataframe,
     metric: a string literal for the rate being evaluated and
     features: a list of categorical variables 
     '''
+    import matplotlib.pyplot as plt
+    paths = []
     for feature in features:
-        df[feature].value_counts().plot(kind='bar', xlabel=feature, ylabel="Count", rot=0)
-        plt.show()
+        fig, ax = plt.subplots()
+        df[feature].value_counts().plot(kind='bar', xlabel=feature, ylabel="Count", rot=0, ax=ax)
+        paths += finish_figure(fig, out_dir, f'bar_{feature}', fmt)
+    return paths
 
 
-def plot_hist(df):
+def plot_hist(df, out_dir=None, fmt='png'):
     """
     Plots the distribution of the dataframe's variables.
     """
-    df.hist(figsize=(24, 20), bins=20)
+    axes = df.hist(figsize=(24, 20), bins=20)
+    if out_dir is None:
+        return []
+    return finish_figure(np.ravel(axes)[0].figure, out_dir, 'hist', fmt)
+
+
+# name of the argument holding the feature list, for helpers not using 'features'
+FEATURE_ARGS = {'swarrrm': 'num_vars'}
+
+
+def get_feature_arg(plot_func):
+    '''
+    returns the name of the argument plot_func takes its feature list in,
+    or None for helpers that plot every column of the frame (e.g. plot_hist)
+    '''
+    list_arg = FEATURE_ARGS.get(plot_func.__name__, 'features')
+    return list_arg if list_arg in inspect.signature(plot_func).parameters else None
+
+
+def render_one(plot_func, df, feature, out_dir, fmt, kwargs):
+    '''
+    renders the figure of a single feature with plot_func (or, if feature is
+    None, plot_func's figure of the whole frame) and returns its paths
+    '''
+    if feature is not None:
+        kwargs = dict(kwargs, **{get_feature_arg(plot_func): [feature]})
+    return plot_func(df, out_dir=out_dir, fmt=fmt, **kwargs)
+
+
+def write_plot_index(paths, out_dir, title='plots'):
+    '''
+    writes an index.html into out_dir showing every figure in paths
+    and returns its path
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    items = []
+    for path in paths:
+        src = html.escape(os.path.relpath(path, out_dir))
+        name = html.escape(os.path.splitext(os.path.basename(path))[0])
+        items.append(f'<figure><img src="{src}" alt="{name}"><figcaption>{name}</figcaption></figure>')
+    index = os.path.join(out_dir, 'index.html')
+    with open(index, 'w') as f:
+        f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{0}</title></head>\n'
+                '<body><h1>{0}</h1>\n{1}\n</body></html>\n'.format(html.escape(title), '\n'.join(items)))
+    return index
+
+
+def render_plots(plot_func, df, features, out_dir, fmt='png', n_jobs=None, **kwargs):
+    '''
+    Renders one figure per feature with plot_func (one of the helpers above,
+    e.g. make_violin2) into out_dir as fmt files without showing them;
+    kwargs are the helper's other arguments, e.g. target='reassault'.
+    Helpers without a feature list argument, such as plot_hist, plot the whole
+    frame they are given, so they are rendered once, on the features columns.
+    n_jobs: if more than 1, features are rendered in that many worker
+    processes on the Agg backend; each worker only receives the columns it plots.
+
+    Writes an index.html linking every figure and returns its path
+    '''
+    columns = [value for value in kwargs.values() if isinstance(value, str) and value in df.columns]
+    if get_feature_arg(plot_func) is None:
+        jobs = [(plot_func, df[list(dict.fromkeys(list(features) + columns))],
+                 None, out_dir, fmt, kwargs)]
+    else:
+        jobs = [(plot_func, df[list(dict.fromkeys([feature] + columns))], feature, out_dir, fmt, kwargs)
+                for feature in features]
+    if n_jobs is not None and n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=use_headless) as pool:
+            results = list(pool.map(render_one, *zip(*jobs)))
+    else:
+        results = [render_one(*job) for job in jobs]
+    return write_plot_index([path for paths in results for path in paths], out_dir,
+                            title=plot_func.__name__)
 
 # ==================================================
 # MAIN
@@ -15,56 +15,213 @@ Used with permission.
 # ENVIRONMENT
 # ===========
 
+import json
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass
+
 import pandas as pd
 import numpy as np
 
-# sklearn machine learning
-# logistic regression
-from sklearn.linear_model import LogisticRegression
-from sklearn.linear_model import LogisticRegressionCV
+import prepare
+
+# fitted models are saved here by register_model, one directory per model
+REGISTRY_PATH = 'models/'
+OOF_THRESHOLDS = (0.25, 0.5, 0.75)
+
+# sklearn estimators and the tree plotting libraries (pydotplus, IPython)
+# are imported inside the functions that use them, so a worker that only
+# needs one model does not pay for the rest, and graphviz is optional
+
+
+@dataclass
+class TrainResult:
+    '''
+    What the trainers return:
+    model: the fitted estimator,
+    y_pred and y_pred_proba: its predictions and probabilities on X_train,
+    cv_scores: per-fold test scores of the chosen model from the trainer's own search,
+    cv_results: a pandas frame with the mean test score of every searched setting,
+    best_params: the chosen hyperparameters, as searched,
+    oof_proba: out-of-fold probabilities of the chosen setting, one row per row of
+    X_train, each predicted by the fold model that did not train on it
+    (NaN for rows no fold scored), for stacking and calibration,
+    oof_metrics: metrics of oof_proba (see get_oof_metrics)
+
+    For a halving search over an estimator parameter, cv_scores, cv_results,
+    best_params, oof_proba and oof_metrics all belong to the last round's
+    resource (e.g. 99 trees), while model is refit at max_resources
+    (see get_best_estimator).
+
+    Unpacks as (model, y_pred, y_pred_proba), like the tuples returned before.
+    '''
+    model: object
+    y_pred: np.ndarray
+    y_pred_proba: np.ndarray
+    cv_scores: np.ndarray = None
+    cv_results: pd.DataFrame = None
+    best_params: dict = None
+    oof_proba: np.ndarray = None
+    oof_metrics: dict = None
+
+    def __iter__(self):
+        return iter((self.model, self.y_pred, self.y_pred_proba))
+
+
+def make_search(estimator, params, cv, n_jobs=None, search='grid', n_iter=20,
+                resource='n_samples', max_resources='auto', random_state=0, scoring=None):
+    '''
+    Creates the hyperparameter search used by the trainers:
+    search: 'grid' (every combination of params, the default),
+    'random' (n_iter settings sampled from params, whose values may be lists
+    or scipy distributions), or
+    'halving' (successive halving over n_iter sampled settings, 'exhaust' if None:
+    all candidates start on a small amount of resource and only the best third
+    move on to three times as much, so the last round uses close to max_resources).
+    resource: what halving grows, 'n_samples' (rows) or an estimator
+    parameter such as 'n_estimators'; rows cannot be grown when cv is a fold plan.
+    The last round can stop short of max_resources, so halving over an
+    estimator parameter does not refit; get_best_estimator fits the best
+    setting at max_resources instead.
+    scoring: passed to the search (None: the estimator's accuracy), e.g. an OutOfFoldScorer.
+    '''
+    from sklearn.model_selection import GridSearchCV, RandomizedSearchCV
+    if search == 'grid':
+        return GridSearchCV(estimator, params, cv=cv, n_jobs=n_jobs, scoring=scoring)
+    if search == 'random':
+        return RandomizedSearchCV(estimator, params, n_iter=n_iter, cv=cv,
+                                  n_jobs=n_jobs, random_state=random_state, scoring=scoring)
+    if search == 'halving':
+        if resource == 'n_samples' and not isinstance(cv, int):
+            raise ValueError('halving over rows needs an integer cv_num, not a fold plan')
+        from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+        from sklearn.model_selection import HalvingRandomSearchCV
+        return HalvingRandomSearchCV(estimator, params,
+                                     n_candidates='exhaust' if n_iter is None else n_iter,
+                                     resource=resource,
+                                     max_resources=max_resources,
+                                     min_resources='exhaust',
+                                     refit=(resource == 'n_samples'),
+                                     cv=cv,
+                                     n_jobs=n_jobs,
+                                     random_state=random_state,
+                                     scoring=scoring)
+    raise ValueError("search must be 'grid', 'random' or 'halving', got {!r}".format(search))
+
+
+def get_best_estimator(search, X_train, y_train):
+    '''
+    returns the best estimator of a fitted search (see make_search), refit on
+    X_train; a halving search over an estimator parameter is not refit by
+    the search itself, so its best setting is fit here with that parameter
+    at max_resources (e.g. the n_estimators asked for, not the last round's)
+    '''
+    if hasattr(search, 'best_estimator_'):
+        return search.best_estimator_
+    from sklearn.base import clone
+    params = dict(search.best_params_, **{search.resource: search.max_resources_})
+    return clone(search.estimator).set_params(**params).fit(X_train, y_train)
+
 
-# NB:
-from sklearn.naive_bayes import GaussianNB
+def get_search_results(search):
+    '''
+    takes a fitted search (see make_search) and returns
+    a pandas frame of every parameter setting with its mean test score and
+    an array of the best setting's per-fold test scores
+    '''
+    results = search.cv_results_
+    cv_results = pd.DataFrame(list(results['params']))
+    if 'n_resources' in results:
+        cv_results['n_resources'] = results['n_resources']
+    cv_results['score'] = results['mean_test_score']
+    cv_scores = np.array([results['split{}_test_score'.format(i)][search.best_index_]
+                          for i in range(search.n_splits_)])
+    return cv_results, cv_scores
 
-# Decision Tree
-from sklearn import tree
-from sklearn.tree import DecisionTreeClassifier
-import graphviz
-from io import StringIO
-from IPython.display import Image
-import pydotplus
 
-# cross-validation
-from sklearn.model_selection import GridSearchCV
-from sklearn.model_selection import cross_val_score
+def make_folds(y_train, cv_num=5, shuffle=True, random_state=0):
+    '''
+    Precomputes a stratified fold plan for y_train that can be passed as folds
+    to every trainer, so all models are tuned and scored on the same splits
+    cv_num: number of folds, default to 5
+    shuffle and random_state: passed to sklearn's StratifiedKFold
 
-# Random Forest
-from sklearn.ensemble import RandomForestClassifier
+    returns a list of (train positions, test positions) pairs
+    '''
+    from sklearn.model_selection import StratifiedKFold
+    skf = StratifiedKFold(n_splits=cv_num,
+                          shuffle=shuffle,
+                          random_state=random_state if shuffle else None)
+    return list(skf.split(np.zeros(len(y_train)), y_train))
+
+
+def parallel_backend(backend=None):
+    '''
+    returns a context manager running joblib work on the given backend
+    ('loky' processes, 'threading' or 'multiprocessing'), or the default if None
+    '''
+    if backend is None:
+        return nullcontext()
+    from joblib import parallel_backend as joblib_backend
+    return joblib_backend(backend)
 
-# SVC:
-from sklearn.svm import SVC
 
+def print_cv_results(result):
+    '''
+    prints the grid and per-fold cross validation results of a TrainResult,
+    and its out-of-fold metrics if it has them
+    '''
+    if result.cv_results is not None:
+        print('grid cv results: ')
+        print(result.cv_results.sort_values(by='score'))
+    print('Cross Validation Results: ')
+    print(result.cv_scores)
+    if result.oof_metrics is not None:
+        print('Out-of-fold ROC-AUC: {:.4f}  PR-AUC: {:.4f}'.format(
+            result.oof_metrics['roc_auc'], result.oof_metrics['pr_auc']))
+        print(result.oof_metrics['by_threshold'])
 
-def naive_bayes(feature_list, X_train, y_train):
+def naive_bayes(feature_list, X_train, y_train, folds=None):
     '''
     Creates a Naive Bayes model based on
     feature_list: a list of features,
     X_train: a pandas frame of features,
     and
     y_train:  a pandas frame of targets
+    kwargs:
+    folds: a fold plan from make_folds; naive Bayes has nothing to tune and
+    runs no cross-validation, so only if folds are given is a model fit per
+    fold for out-of-fold probabilities and metrics (default None).
 
-    returns predictions and probabilities in addition to the model itself.
+    returns predictions and probabilities in addition to the model itself
+    (as a TrainResult).
     '''
+    from sklearn.naive_bayes import GaussianNB
     fit_frame = X_train[feature_list]
     gnb = GaussianNB().fit(fit_frame, y_train)
     # make predictions with the model
     y_pred = gnb.predict(fit_frame)
     # predict probability with the model
     y_pred_proba = gnb.predict_proba(fit_frame)
-    return gnb, y_pred, y_pred_proba
+    if folds is None:
+        return TrainResult(gnb, y_pred, y_pred_proba)
+    y_values = np.asarray(y_train)
+    oof_proba = np.full(y_pred_proba.shape, np.nan)
+    for train, test in folds:
+        fold_nb = GaussianNB().fit(fit_frame.iloc[train], y_values[train])
+        oof_proba[test] = fold_nb.predict_proba(fit_frame.iloc[test])
+    return TrainResult(gnb, y_pred, y_pred_proba,
+                       oof_proba=oof_proba,
+                       oof_metrics=get_oof_metrics(y_train, oof_proba, gnb.classes_))
 
 
-def log_reg(feature_list, X_train, y_train, cv_num=5, solver='lbfgs'):
+def log_reg(feature_list, X_train, y_train, cv_num=5, solver='lbfgs',
+            folds=None, n_jobs=None, backend=None):
     '''
     Creates a Logistic Regression model based on
     feature_list: a list of features,
@@ -74,19 +231,39 @@ def log_reg(feature_list, X_train, y_train, cv_num=5, solver='lbfgs'):
     kwargs:
     cv_num: integer for number of cross-validation folds, default to 5.
     solver: hyperparameter for logistic regression, default to lbfgs.
+    folds: a fold plan from make_folds, used instead of cv_num folds.
+    n_jobs: number of parallel jobs for the cross-validation (default 1).
+    backend: joblib backend for those jobs (see parallel_backend).
     (Refer to sklearn documentation for further information)
 
-    returns predictions and probabilities of outcome
-    prints cross validation results of each model
+    returns predictions and probabilities of outcome (as a TrainResult)
+    prints cross validation results of each model, taken from the
+    cross-validation LogisticRegressionCV already runs to choose C;
+    for two classes, the out-of-fold probabilities come from the coefficients
+    each fold fit at the chosen C (get_log_reg_oof)
     '''
-    clf = LogisticRegressionCV(cv=cv_num,
-                               random_state=0,
-                               solver=solver).fit(X_train[feature_list], y_train)
-    print('Cross Validation Results: ')
-    print(cross_val_score(clf, X_train[feature_list], y_train, cv=cv_num))
-    y_pred = clf.predict(X_train[feature_list])
-    y_pred_proba = clf.predict_proba(X_train[feature_list])
-    return clf, y_pred, y_pred_proba
+    from sklearn.linear_model import LogisticRegressionCV
+    fit_frame = X_train[feature_list]
+    with parallel_backend(backend):
+        clf = LogisticRegressionCV(cv=cv_num if folds is None else folds,
+                                   random_state=0,
+                                   solver=solver,
+                                   n_jobs=n_jobs).fit(fit_frame, y_train)
+    # fold x C accuracy grid of the (first) class
+    scores = next(iter(clf.scores_.values()))
+    best = int(np.argmin(np.abs(clf.Cs_ - clf.C_[0])))
+    oof_proba = get_log_reg_oof(clf, fit_frame, y_train, cv_num if folds is None else folds, best)
+    result = TrainResult(clf,
+                         clf.predict(fit_frame),
+                         clf.predict_proba(fit_frame),
+                         cv_scores=scores[:, best],
+                         cv_results=pd.DataFrame({'C': clf.Cs_, 'score': scores.mean(axis=0)}),
+                         best_params={'C': clf.C_[0]},
+                         oof_proba=oof_proba,
+                         oof_metrics=None if oof_proba is None else
+                         get_oof_metrics(y_train, oof_proba, clf.classes_))
+    print_cv_results(result)
+    return result
 
 
 def decision_tree(feature_list,
@@ -96,7 +273,13 @@ def decision_tree(feature_list,
                           'max_features': [None, 1, 3]},
                   criterion='entropy',
                   max_depth=4,
-                  max_features=3):
+                  max_features=3,
+                  cv_num=5,
+                  folds=None,
+                  n_jobs=None,
+                  backend=None,
+                  search='grid',
+                  n_iter=20):
     '''
     Creates a Decision Tree model based on
     feature_list: a list of features,
@@ -108,28 +291,39 @@ def decision_tree(feature_list,
     default depths [2, 3, 4] default max_features [0, 1, 3]
     criterion (default entropy),
     max_depth (default 4), and
-    max_feature (default 3) hyperparameters
+    max_feature (default 3) hyperparameters, used where params does not search them
+    cv_num: integer for number of cross-validation folds, default to 5.
+    folds: a fold plan from make_folds, used instead of cv_num folds.
+    n_jobs: number of parallel jobs for the grid search (default 1).
+    backend: joblib backend for those jobs (see parallel_backend).
+    search: 'grid' (default), 'random' or 'halving' over rows, with n_iter
+    settings sampled from params (see make_search), e.g.
+    params={'max_depth': [2, 3, 4, 6, 8], 'min_samples_leaf': [1, 3, 5, 10],
+            'max_features': [None, 'sqrt', 3], 'class_weight': [None, 'balanced']}
     (see sklearn documentation for more information)
 
-    Returns a decision tree model in addition to printing predictions and probabilities
+    Returns the best tree of the grid search, refit on all of X_train,
+    in addition to printing predictions and probabilities (as a TrainResult)
     '''
+    from sklearn.tree import DecisionTreeClassifier
+    fit_frame = X_train[feature_list]
     dtc = DecisionTreeClassifier(
         criterion=criterion, max_depth=max_depth, max_features=max_features, random_state=0)
-    grid = GridSearchCV(dtc, params, cv=3, iid=True)
-    grid.fit(X_train[feature_list], y_train)
-    results = grid.cv_results_
-    test_scores = results['mean_test_score']
-    params = results['params']
-    for p, s in zip(params, test_scores):
-        p['score'] = s
-    dtc.fit(X_train[feature_list], y_train)
-    print('grid cv results: ')
-    print(pd.DataFrame(params).sort_values(by='score'))
-    print('Cross Validation Results: ')
-    print(cross_val_score(dtc, X_train[feature_list], y_train, cv=5))
-    y_pred = dtc.predict(X_train[feature_list])
-    y_pred_proba = dtc.predict_proba(X_train[feature_list])
-    return dtc, y_pred, y_pred_proba
+    grid = make_search(dtc, params, cv_num if folds is None else folds, n_jobs=n_jobs,
+                       search=search, n_iter=n_iter)
+    oof_proba = fit_search(grid, fit_frame, y_train, backend)
+    cv_results, cv_scores = get_search_results(grid)
+    dtc = grid.best_estimator_
+    result = TrainResult(dtc,
+                         dtc.predict(fit_frame),
+                         dtc.predict_proba(fit_frame),
+                         cv_scores=cv_scores,
+                         cv_results=cv_results,
+                         best_params=grid.best_params_,
+                         oof_proba=oof_proba,
+                         oof_metrics=get_oof_metrics(y_train, oof_proba, dtc.classes_))
+    print_cv_results(result)
+    return result
 
 
 def plot_decision_tree(clf, feature_name, target_name):
@@ -139,6 +333,10 @@ def plot_decision_tree(clf, feature_name, target_name):
     clf: a decision tree object,
     feature_name: feature name of the training set and a
     target_name: a target variable name (list formatted)'''
+    from io import StringIO
+    from sklearn import tree
+    from IPython.display import Image
+    import pydotplus
     dot_data = StringIO()
     tree.export_graphviz(clf, out_file=dot_data,
                          feature_names=feature_name,
@@ -160,7 +358,12 @@ def random_forest(feature_list,
                   n_estimators=100,
                   max_depth=3,
                   random_state=0,
-                  r_params={'max_depth': [2, 3, 4]}):
+                  r_params={'max_depth': [2, 3, 4]},
+                  folds=None,
+                  n_jobs=None,
+                  backend=None,
+                  search='grid',
+                  n_iter=20):
     '''
     Creates a Decision Tree model based on
     feature_list: a list of features,
@@ -177,33 +380,582 @@ def random_forest(feature_list,
     max_depth: (default 3), and
     random_state: (default 0)
     r_params: a dictionary of depth hyperparameters for grid cross-validation. (default depths [2, 3, 4])
+    folds: a fold plan from make_folds, used instead of cv_num folds.
+    n_jobs: number of parallel jobs for the grid search and for building
+    the trees of the final forest (default 1).
+    backend: joblib backend for those jobs (see parallel_backend).
+    search: 'grid' (default), 'random', or 'halving' over the number of trees
+    (up to n_estimators; the best setting is refit with n_estimators trees,
+    while the reported scores, best_params and out-of-fold results are those
+    of the last round's number of trees),
+    with n_iter settings sampled from r_params
+    (see make_search), e.g.
+    r_params={'max_depth': [2, 3, 4, 6, 8], 'min_samples_leaf': [1, 3, 5, 10],
+              'max_features': ['sqrt', 0.5, None], 'class_weight': [None, 'balanced']}
     (see sklearn documentation for more information)
 
-    Returns a decision tree model in addition to printing predictions and probabilities
+    Returns the best forest of the grid search, refit on all of X_train,
+    in addition to printing predictions and probabilities (as a TrainResult)
     '''
+    from sklearn.ensemble import RandomForestClassifier
+    fit_frame = X_train[feature_list]
     rf = RandomForestClassifier(bootstrap=bootstrap,
                                 class_weight=class_weight,
                                 criterion=criterion,
                                 min_samples_leaf=min_samples_leaf,
                                 n_estimators=n_estimators,
                                 max_depth=max_depth,
-                                random_state=random_state)
-    r_grid = GridSearchCV(rf, r_params, cv=3, iid=True)
-    r_grid.fit(X_train[feature_list], y_train)
-    r_results = r_grid.cv_results_
-    r_test_scores = r_results['mean_test_score']
-    r_params = r_results['params']
-    for p, s in zip(r_params, r_test_scores):
-        p['score'] = s
-    rf.fit(X_train[feature_list], y_train)
-    cross_val_score(rf, X_train[feature_list], y_train, cv=5)
-    y_pred = rf.predict(X_train[feature_list])
-    y_pred_proba = rf.predict_proba(X_train[feature_list])
-    print('grid cv results: ')
-    print(pd.DataFrame(r_params).sort_values(by='score'))
-    print('Cross Validation Results: ')
-    print(cross_val_score(rf, X_train[feature_list], y_train, cv=5))
-    return rf, y_pred, y_pred_proba
+                                random_state=random_state,
+                                n_jobs=n_jobs)
+    r_grid = make_search(rf, r_params, cv_num if folds is None else folds, n_jobs=n_jobs,
+                         search=search, n_iter=n_iter, resource='n_estimators',
+                         max_resources=n_estimators, random_state=random_state)
+    oof_proba = fit_search(r_grid, fit_frame, y_train, backend)
+    cv_results, cv_scores = get_search_results(r_grid)
+    with parallel_backend(backend):
+        rf = get_best_estimator(r_grid, fit_frame, y_train)
+    result = TrainResult(rf,
+                         rf.predict(fit_frame),
+                         rf.predict_proba(fit_frame),
+                         cv_scores=cv_scores,
+                         cv_results=cv_results,
+                         best_params=r_grid.best_params_,
+                         oof_proba=oof_proba,
+                         oof_metrics=get_oof_metrics(y_train, oof_proba, rf.classes_))
+    print_cv_results(result)
+    return result
+
+# ===================
+# OUT-OF-FOLD RESULTS
+# ===================
+
+def get_params_key(estimator):
+    '''
+    returns a hash of an estimator's parameters, naming a search candidate
+    '''
+    from joblib import hash as joblib_hash
+    return joblib_hash(sorted(estimator.get_params(deep=False).items()))
+
+
+class OutOfFoldScorer:
+    '''
+    A search scorer that scores like the default (accuracy) and also saves
+    each fold model's probabilities on its test rows to out_dir, one .npy file
+    per call named by the candidate's parameters and the time, so
+    get_search_oof can put the chosen setting's out-of-fold probabilities
+    together without fitting anything again.
+    the search must be fit on a frame whose index is the row positions;
+    files (not attributes) carry the results back from worker processes
+    '''
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+
+    def __call__(self, estimator, X, y):
+        proba = estimator.predict_proba(X)
+        name = '{}-{}-{}.npy'.format(get_params_key(estimator), time.time_ns(), os.getpid())
+        np.save(os.path.join(self.out_dir, name),
+                np.column_stack([X.index.to_numpy(), proba]), allow_pickle=False)
+        return float(np.mean(estimator.classes_.take(np.argmax(proba, axis=1)) == np.asarray(y)))
+
+
+def fit_search(search, fit_frame, y_train, backend=None):
+    '''
+    fits a search from make_search with an OutOfFoldScorer and returns the
+    chosen setting's out-of-fold probabilities (see get_search_oof)
+    '''
+    out_dir = tempfile.mkdtemp(prefix='oof-')
+    try:
+        search.set_params(scoring=OutOfFoldScorer(out_dir))
+        with parallel_backend(backend):
+            search.fit(fit_frame.reset_index(drop=True), np.asarray(y_train))
+        return get_search_oof(search, out_dir, len(fit_frame))
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def get_search_oof(search, out_dir, n_rows):
+    '''
+    takes a search fit with an OutOfFoldScorer writing to out_dir and returns
+    an n_rows x classes array of the best setting's out-of-fold probabilities;
+    only the best setting's last round of folds is used (halving scores it
+    on several amounts of resource), and rows that round did not score
+    (halving over rows) are NaN
+    '''
+    from sklearn.base import clone
+    key = get_params_key(clone(search.estimator).set_params(**search.best_params_))
+    names = [name for name in os.listdir(out_dir) if name.startswith(key + '-')]
+    names.sort(key=lambda name: int(name.split('-')[1]))
+    saved = [np.load(os.path.join(out_dir, name)) for name in names[-search.n_splits_:]]
+    oof = np.full((n_rows, saved[0].shape[1] - 1), np.nan)
+    for fold in saved:
+        oof[fold[:, 0].astype(np.intp)] = fold[:, 1:]
+    return oof
+
+
+def get_fold_plan(cv, X_train, y_train):
+    '''
+    returns the (train positions, test positions) pairs sklearn uses for cv:
+    a fold plan from make_folds as it is, or cv folds of a stratified split
+    '''
+    if not isinstance(cv, int):
+        return list(cv)
+    from sklearn.model_selection import check_cv
+    return list(check_cv(cv, y_train, classifier=True).split(X_train, y_train))
+
+
+def get_log_reg_oof(clf, X_train, y_train, cv, best):
+    '''
+    returns the out-of-fold probabilities of a fitted two-class
+    LogisticRegressionCV at its best C (index best of Cs_), from the
+    coefficients each fold fit on the way (coefs_paths_) and the folds of cv;
+    None for more than two classes
+    '''
+    from scipy.special import expit
+    if len(clf.classes_) != 2:
+        return None
+    paths = next(iter(clf.coefs_paths_.values()))
+    X_values = np.asarray(X_train, dtype=np.float64)
+    oof = np.full((len(X_values), 2), np.nan)
+    for (train, test), path in zip(get_fold_plan(cv, X_values, y_train), paths):
+        coef = path[best]
+        scores = X_values[test] @ coef[:X_values.shape[1]]
+        if len(coef) > X_values.shape[1]:
+            scores += coef[-1]
+        positive = expit(scores)
+        oof[test] = np.column_stack([1 - positive, positive])
+    return oof
+
+
+def get_oof_metrics(y_true, oof_proba, classes, thresholds=OOF_THRESHOLDS):
+    '''
+    Scores out-of-fold probabilities of the positive class (1, or the last class)
+    against y_true, over the rows that have them:
+    roc_auc, pr_auc (average precision), n_scored (rows scored), and
+    by_threshold: a pandas frame with, for every threshold (positive if
+    probability >= threshold), recall, precision and the confusion matrix
+    counts tn, fp, fn, tp
+
+    returns a dictionary
+    '''
+    from sklearn.metrics import average_precision_score, confusion_matrix, roc_auc_score
+    classes = list(classes)
+    positive = classes.index(1) if 1 in classes else -1
+    scored = ~np.isnan(oof_proba).any(axis=1)
+    actual = np.asarray(y_true)[scored] == classes[positive]
+    proba = oof_proba[scored, positive]
+    rows = []
+    for threshold in thresholds:
+        tn, fp, fn, tp = confusion_matrix(actual, proba >= threshold,
+                                          labels=[False, True]).ravel()
+        rows.append({'threshold': threshold,
+                     'recall': float(tp / (tp + fn)) if tp + fn else np.nan,
+                     'precision': float(tp / (tp + fp)) if tp + fp else np.nan,
+                     'tn': int(tn), 'fp': int(fp), 'fn': int(fn), 'tp': int(tp)})
+    return {'roc_auc': float(roc_auc_score(actual, proba)),
+            'pr_auc': float(average_precision_score(actual, proba)),
+            'n_scored': int(scored.sum()),
+            'by_threshold': pd.DataFrame(rows)}
+
+# ==============
+# MODEL REGISTRY
+# ==============
+
+def get_data_fingerprint(feature_list, X_train, y_train):
+    '''
+    returns a hash of the feature columns (names and values) and targets a model is trained on
+    '''
+    from joblib import hash as joblib_hash
+    rows = pd.util.hash_pandas_object(X_train[feature_list], index=False).to_numpy()
+    targets = pd.util.hash_pandas_object(pd.Series(np.asarray(y_train)), index=False).to_numpy()
+    return joblib_hash((list(feature_list), rows, targets))
+
+
+def get_model_key(trainer, feature_list, X_train, y_train, prep_key=None, **kwargs):
+    '''
+    returns the registry key of a trainer run: a hash of the trainer's name,
+    the data fingerprint, the preparation config hash (prep_key, e.g. from
+    prepare.get_prepared_key) and the trainer's other arguments
+    '''
+    from joblib import hash as joblib_hash
+    return joblib_hash((trainer.__name__,
+                        get_data_fingerprint(feature_list, X_train, y_train),
+                        prep_key,
+                        sorted(kwargs.items())))
+
+
+def save_model(result, key, trainer, feature_list, prep_key=None):
+    '''
+    saves a TrainResult to REGISTRY_PATH/<trainer>-<key>/ as an uncompressed
+    joblib file (so its plain arrays can be memory-mapped on load) next to a meta.json
+    holding the feature list, preparation config hash, cv and out-of-fold metrics, and,
+    for models compile_model supports, the compiled arrays in compiled/;
+    returns the directory
+    '''
+    import joblib
+    model_dir = os.path.join(REGISTRY_PATH, '{}-{}'.format(trainer.__name__, key))
+    tmp_dir = '{}.tmp{}'.format(model_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    joblib.dump({'model': result.model,
+                 'y_pred': result.y_pred,
+                 'y_pred_proba': result.y_pred_proba,
+                 'cv_scores': result.cv_scores,
+                 'cv_results': result.cv_results,
+                 'best_params': result.best_params,
+                 'oof_proba': result.oof_proba,
+                 'oof_metrics': result.oof_metrics},
+                os.path.join(tmp_dir, 'model.joblib'))
+    meta = {'trainer': trainer.__name__,
+            'features': list(feature_list),
+            'prep_key': prep_key,
+            'cv_scores': None if result.cv_scores is None else [float(x) for x in result.cv_scores],
+            'best_params': None if result.best_params is None else
+            {k: v if isinstance(v, (str, int, float, bool, type(None))) else repr(v)
+             for k, v in result.best_params.items()},
+            'oof_metrics': None if result.oof_metrics is None else
+            {'roc_auc': result.oof_metrics['roc_auc'],
+             'pr_auc': result.oof_metrics['pr_auc'],
+             'by_threshold': result.oof_metrics['by_threshold'].to_dict(orient='records')}}
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    try:
+        save_compiled(compile_model(result.model), os.path.join(tmp_dir, 'compiled'))
+    except (TypeError, ValueError):
+        pass
+    shutil.rmtree(model_dir, ignore_errors=True)
+    os.rename(tmp_dir, model_dir)
+    return model_dir
+
+
+def load_model(model_dir, mmap_mode='r'):
+    '''
+    loads a TrainResult saved by save_model; with mmap_mode='r' (default)
+    plain arrays such as y_pred_proba and oof_proba are memory-mapped from
+    disk. The fitted model itself is not: sklearn copies tree nodes and
+    values into its own buffers when unpickling. Scoring workers that want
+    memory-mapped model arrays should use load_scorer / load_compiled.
+    returns None if the directory is missing or cannot be loaded
+    '''
+    import joblib
+    path = os.path.join(model_dir, 'model.joblib')
+    if not os.path.exists(path):
+        return None
+    try:
+        saved = joblib.load(path, mmap_mode=mmap_mode)
+    except (OSError, EOFError, ValueError, AttributeError, ImportError, pickle.UnpicklingError):
+        return None
+    return TrainResult(**saved)
+
+
+def register_model(trainer, feature_list, X_train, y_train, prep_key=None, refit=False, **kwargs):
+    '''
+    Runs trainer (naive_bayes, log_reg, decision_tree or random_forest) through
+    the local model registry:
+    if the same trainer was already run on the same data fingerprint,
+    preparation config (prep_key) and arguments, the saved TrainResult is
+    loaded (see load_model) and its cv results printed; otherwise the trainer
+    runs and its result is saved. refit=True always retrains.
+    kwargs are passed to the trainer.
+
+    returns the TrainResult
+    '''
+    key = get_model_key(trainer, feature_list, X_train, y_train, prep_key, **kwargs)
+    model_dir = os.path.join(REGISTRY_PATH, '{}-{}'.format(trainer.__name__, key))
+    if not refit:
+        result = load_model(model_dir)
+        if result is not None:
+            if result.cv_scores is not None:
+                print_cv_results(result)
+            return result
+    result = trainer(feature_list, X_train, y_train, **kwargs)
+    save_model(result, key, trainer, feature_list, prep_key)
+    return result
+
+# ================
+# COMPILED SCORING
+# ================
+
+class LinearEvaluator:
+    '''
+    A logistic regression reduced to its coefficients, for scoring single rows
+    without sklearn's per-call validation overhead; predict_proba matches the
+    model's (sigmoid for two classes, softmax otherwise).
+    the sigmoid is scipy's expit, as in sklearn (NumPy's exp can differ in the
+    last bit), imported here so building the evaluator, not its first call,
+    pays for the import
+    '''
+    def __init__(self, coef, intercept, classes):
+        from scipy.special import expit
+        self.expit = expit
+        self.coef = np.ascontiguousarray(coef, dtype=np.float64)
+        self.intercept = np.asarray(intercept, dtype=np.float64)
+        self.classes_ = np.asarray(classes)
+
+    def get_arrays(self):
+        '''
+        returns the constructor arguments as a dictionary of arrays
+        '''
+        return {'coef': self.coef, 'intercept': self.intercept, 'classes': self.classes_}
+
+    def predict_proba(self, rows):
+        '''
+        rows: a 2-d array with the model's features as columns
+        '''
+        scores = np.asarray(rows, dtype=np.float64) @ self.coef.T + self.intercept
+        if self.coef.shape[0] == 1:
+            positive = self.expit(scores[:, 0])
+            return np.column_stack([1 - positive, positive])
+        scores = np.exp(scores - scores.max(axis=1, keepdims=True))
+        return scores / scores.sum(axis=1, keepdims=True)
+
+
+class TreeEvaluator:
+    '''
+    One or more decision trees (a single tree or the trees of a random forest)
+    flattened into contiguous arrays: for every node, its split feature,
+    threshold, left and right child (children, indices into the same arrays;
+    a leaf is its own child on both sides), the side samples with missing
+    values take, and its class probabilities; roots holds the first node of
+    each tree and depth the deepest tree's depth.
+    predict_proba moves every (row, tree) pair down one level per step, for
+    depth steps, then sums the trees' leaf probabilities in tree order and
+    divides by the number of trees, so it matches the model's own predict_proba
+    '''
+    def __init__(self, feature, threshold, children, missing_left, proba, roots, depth, classes):
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.missing_left = missing_left
+        self.proba = proba
+        self.roots = roots
+        self.depth = int(depth)
+        self.classes_ = np.asarray(classes)
+
+    @classmethod
+    def from_trees(cls, trees, classes):
+        '''
+        builds the evaluator from fitted DecisionTreeClassifiers sharing classes
+        '''
+        sizes = [clf.tree_.node_count for clf in trees]
+        roots = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int32)
+        parts = {'feature': [], 'threshold': [], 'children': [], 'missing_left': [], 'proba': []}
+        for clf, root in zip(trees, roots):
+            tree = clf.tree_
+            nodes = np.arange(tree.node_count) + root
+            leaf = tree.children_left < 0
+            value = tree.value[:, 0, :len(classes)]
+            # sklearn < 1.4 stores class counts (normalized at predict time),
+            # later versions the class fractions themselves
+            totals = value.sum(axis=1, keepdims=True)
+            if not np.allclose(totals, 1.0):
+                totals[totals == 0.0] = 1.0
+                value = value / totals
+            parts['feature'].append(np.where(leaf, 0, tree.feature))
+            parts['threshold'].append(tree.threshold)
+            parts['children'].append(np.column_stack(
+                [np.where(leaf, nodes, tree.children_left + root),
+                 np.where(leaf, nodes, tree.children_right + root)]))
+            parts['missing_left'].append(getattr(tree, 'missing_go_to_left',
+                                                 np.zeros(tree.node_count, dtype=np.uint8)))
+            parts['proba'].append(value)
+        dtypes = {'feature': np.int32, 'threshold': np.float64, 'children': np.int32,
+                  'missing_left': np.bool_, 'proba': np.float64}
+        arrays = {name: np.ascontiguousarray(np.concatenate(parts[name]), dtype=dtypes[name])
+                  for name in parts}
+        depth = max(clf.tree_.max_depth for clf in trees)
+        return cls(roots=roots, depth=depth, classes=classes, **arrays)
+
+    @classmethod
+    def from_tree(cls, clf):
+        '''
+        builds the evaluator from a fitted DecisionTreeClassifier
+        '''
+        return cls.from_trees([clf], clf.classes_)
+
+    @classmethod
+    def from_forest(cls, forest):
+        '''
+        builds the evaluator from a fitted RandomForestClassifier
+        '''
+        return cls.from_trees(forest.estimators_, forest.classes_)
+
+    def get_arrays(self):
+        '''
+        returns the constructor arguments as a dictionary of arrays
+        '''
+        return {'feature': self.feature, 'threshold': self.threshold,
+                'children': self.children, 'missing_left': self.missing_left,
+                'proba': self.proba, 'roots': self.roots,
+                'depth': np.array(self.depth), 'classes': self.classes_}
+
+    def apply(self, rows):
+        '''
+        returns the leaf index of every row in every tree (rows x trees)
+        '''
+        # sklearn compares float32 features against float64 thresholds
+        rows = np.ascontiguousarray(rows, dtype=np.float32)
+        n_rows, n_features = rows.shape
+        has_missing = np.isnan(rows).any()
+        flat_rows = rows.ravel()
+        children = self.children.ravel()
+        starts = np.repeat(np.arange(n_rows) * n_features, len(self.roots))
+        nodes = np.tile(self.roots, n_rows)
+        for _ in range(self.depth):
+            values = flat_rows[starts + self.feature[nodes]]
+            go_right = ~(values <= self.threshold[nodes])
+            if has_missing:
+                go_right = np.where(np.isnan(values), ~self.missing_left[nodes], go_right)
+            nodes = children[2 * nodes + go_right]
+        return nodes.reshape(n_rows, len(self.roots))
+
+    def predict_proba(self, rows):
+        '''
+        rows: a 2-d array with the model's features as columns
+        '''
+        leaves = self.apply(rows)
+        if leaves.shape[1] == 1:
+            return self.proba[leaves[:, 0]]
+        proba = np.zeros((len(leaves), self.proba.shape[1]))
+        for i in range(leaves.shape[1]):
+            proba += self.proba[leaves[:, i]]
+        proba /= leaves.shape[1]
+        return proba
+
+
+EVALUATORS = {'LinearEvaluator': LinearEvaluator, 'TreeEvaluator': TreeEvaluator}
+
+
+def compile_model(clf):
+    '''
+    returns an evaluator without sklearn (NumPy arrays, plus scipy's expit for
+    logistic regression) with the same predict_proba as clf, for a
+    fitted LogisticRegression / LogisticRegressionCV, DecisionTreeClassifier
+    or RandomForestClassifier
+    '''
+    if hasattr(clf, 'tree_'):
+        return TreeEvaluator.from_tree(clf)
+    if hasattr(clf, 'estimators_') and all(hasattr(est, 'tree_') for est in clf.estimators_):
+        return TreeEvaluator.from_forest(clf)
+    if hasattr(clf, 'coef_') and hasattr(clf, 'intercept_'):
+        return LinearEvaluator(clf.coef_, clf.intercept_, clf.classes_)
+    raise TypeError('cannot compile {}'.format(type(clf).__name__))
+
+
+def save_compiled(evaluator, out_dir):
+    '''
+    writes an evaluator's arrays to out_dir as one .npy file each, plus a
+    kind.txt naming its class; returns out_dir
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    for name, values in evaluator.get_arrays().items():
+        np.save(os.path.join(out_dir, name + '.npy'), np.asarray(values), allow_pickle=False)
+    with open(os.path.join(out_dir, 'kind.txt'), 'w') as f:
+        f.write(type(evaluator).__name__)
+    return out_dir
+
+
+def load_compiled(out_dir, mmap_mode='r'):
+    '''
+    loads an evaluator written by save_compiled, memory-mapping its arrays
+    (mmap_mode='r', default), without importing sklearn;
+    returns None if out_dir holds no compiled model
+    '''
+    path = os.path.join(out_dir, 'kind.txt')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        evaluator = EVALUATORS[f.read().strip()]
+    arrays = {name[:-len('.npy')]: np.load(os.path.join(out_dir, name), mmap_mode=mmap_mode)
+              for name in os.listdir(out_dir) if name.endswith('.npy')}
+    return evaluator(**arrays)
+
+
+def compile_registered(model_dir):
+    '''
+    compiles a model saved in the registry into model_dir/compiled
+    (for entries saved before compiled arrays were written) and returns the evaluator
+    '''
+    result = load_model(model_dir)
+    if result is None:
+        raise FileNotFoundError('no registered model in {}'.format(model_dir))
+    evaluator = compile_model(result.model)
+    save_compiled(evaluator, os.path.join(model_dir, 'compiled'))
+    return evaluator
+
+
+# =======
+# SCORING
+# =======
+
+def load_features(model_dir):
+    '''
+    returns the feature list a registered model was trained on
+    '''
+    with open(os.path.join(model_dir, 'meta.json')) as f:
+        return json.load(f)['features']
+
+
+def load_scorer(model_dir, compiled=True):
+    '''
+    returns something with predict_proba and classes_ for a registered model:
+    its compiled arrays, memory-mapped from model_dir/compiled without
+    importing sklearn (if compiled and they exist), else the fitted model
+    '''
+    if compiled:
+        evaluator = load_compiled(os.path.join(model_dir, 'compiled'))
+        if evaluator is not None:
+            return evaluator
+    result = load_model(model_dir)
+    if result is None:
+        raise FileNotFoundError('no registered model in {}'.format(model_dir))
+    return result.model
+
+
+def get_positive_proba(clf, frame):
+    '''
+    returns the predicted probability of the positive class (1) for every row of frame
+    '''
+    proba = clf.predict_proba(frame)
+    classes = list(clf.classes_)
+    return proba[:, classes.index(1) if 1 in classes else -1]
+
+
+def score_csv(model_dir, input_path, output_path, chunksize=10000, prepared=False,
+              id_col='CASEID', compiled=True):
+    '''
+    Scores a csv of case records with a model saved in the registry (model_dir):
+    the file is read chunksize rows at a time, each chunk is renamed and recoded
+    with prepare.prepare_records (skipped if prepared=True, i.e. the columns
+    already carry the prepared names and codes), and the id and the predicted
+    probability of reassault are appended to output_path as each chunk finishes,
+    so memory stays bounded by the chunk size.
+    only the id column and the columns behind the model's features are read.
+    compiled: score with the model's memory-mapped compiled arrays when it has
+    them (see load_scorer; the same probabilities, to the last bit for trees,
+    and a worker starts without sklearn), or False for the fitted sklearn model.
+
+    returns the number of rows scored
+    '''
+    scorer = load_scorer(model_dir, compiled)
+    features = load_features(model_dir)
+    renames = {} if prepared else {**prepare.RENAME_RECID, **prepare.RENAME_ALL}
+    out_id = renames.get(id_col, id_col)
+    wanted = set(features) | {id_col}
+    wanted |= {raw for raw, name in renames.items() if name in wanted}
+    scored = 0
+    for chunk in pd.read_csv(input_path, usecols=lambda col: col in wanted,
+                             chunksize=chunksize, low_memory=False):
+        if not prepared:
+            chunk = prepare.prepare_records(chunk)
+        missing = [feat for feat in features if feat not in chunk.columns]
+        if missing:
+            raise KeyError('{} missing from {}'.format(missing, input_path))
+        out = pd.DataFrame({'proba': get_positive_proba(scorer, chunk[features])})
+        if out_id in chunk.columns:
+            out.insert(0, out_id, chunk[out_id].to_numpy())
+        out.to_csv(output_path, mode='w' if scored == 0 else 'a',
+                   header=(scored == 0), index=False)
+        scored += len(chunk)
+    return scored
 
 # ==================================================
 # MAIN
@@ -212,9 +964,38 @@ def random_forest(feature_list,
 def clear():
     os.system("cls" if os.name == "nt" else "clear")
 
-def main():
-    """Main entry point for the script."""
-    pass
+def main(argv=None):
+    """Main entry point for the script.
+
+    python model.py score MODEL_DIR INPUT_CSV OUTPUT_CSV [--chunksize N] [--prepared]
+    python model.py compile MODEL_DIR [MODEL_DIR ...]
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description='Predicting domestic violence models.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    score = commands.add_parser('score', help='score a csv of case records with a registered model')
+    score.add_argument('model_dir', help='registry directory of the model, e.g. models/log_reg-<key>')
+    score.add_argument('input', help='csv of case records')
+    score.add_argument('output', help='csv to write ids and probabilities to')
+    score.add_argument('--chunksize', type=int, default=10000, help='rows read at a time')
+    score.add_argument('--prepared', action='store_true',
+                       help='records already carry prepared column names and codes')
+    score.add_argument('--sklearn', action='store_true',
+                       help='score with the fitted sklearn model, not its compiled arrays')
+    compile_ = commands.add_parser('compile', help='write the compiled arrays of registered models')
+    compile_.add_argument('model_dirs', nargs='+', help='registry directories')
+    args = parser.parse_args(argv)
+    if args.command == 'compile':
+        for model_dir in args.model_dirs:
+            evaluator = compile_registered(model_dir)
+            print('compiled {} into {}'.format(type(evaluator).__name__,
+                                               os.path.join(model_dir, 'compiled')))
+    if args.command == 'score':
+        rows = score_csv(args.model_dir, args.input, args.output,
+                         chunksize=args.chunksize, prepared=args.prepared,
+                         compiled=not args.sklearn)
+        print('scored {} rows into {}'.format(rows, args.output))
+    return 0
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -15,11 +15,250 @@ Used with permission.
 # ENVIRONMENT
 # ===========
 
+import hashlib
+import os
+import sys
+
 import pandas as pd
 import numpy as np
 import acquire
 
-df10 = acquire.read_data('data10.csv')
+# incident-level table (data10.csv), read on first use by get_incidents;
+# _incidents_set marks a table passed to set_incidents instead
+_incidents = None
+_incidents_set = False
+
+
+def get_incidents():
+    '''
+    returns the incident-level dataframe, reading data10.csv
+    the first time it is needed and reusing it afterwards
+    '''
+    global _incidents
+    if _incidents is None:
+        _incidents = acquire.read_data('data10.csv')
+    return _incidents
+
+
+def set_incidents(df10):
+    '''
+    replaces the incident-level dataframe used by the recidivism helpers,
+    e.g. with a filtered table or a test fixture; pass None to reload from disk
+    '''
+    global _incidents, _incidents_set
+    _incidents = df10
+    _incidents_set = df10 is not None
+
+
+def get_incidents_fingerprint(incidents=None):
+    '''
+    returns a hash of the incident table the recidivism labels come from:
+    incidents if given, else the table passed to set_incidents;
+    None when data10.csv itself is used (its file version is hashed instead)
+    '''
+    if incidents is None:
+        if not _incidents_set:
+            return None
+        incidents = _incidents
+    rows = pd.util.hash_pandas_object(incidents, index=True).to_numpy()
+    digest = hashlib.sha1(rows.tobytes())
+    digest.update(repr(list(incidents.columns)).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def __getattr__(name):
+    # keeps prepare.df10 working without loading it at import time
+    if name == 'df10':
+        return get_incidents()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+# =========
+# RECODING
+# =========
+
+# recoding rules map a column to a sequence of (codes, value) steps;
+# steps are applied in order, with the same result as chaining
+# Series.replace(codes, value) calls
+
+# unreliable/error codes from the data dictionary
+SENTINEL_CODES = (555, 666, 777, 888, 999, 9999)
+
+# columns of dfa that hold counts or scales rather than yes/no answers
+NON_BINARY_ALL = ('length_relationship',
+                  'num_abusers',
+                  'num_children',
+                  'power_scale',
+                  'harass_scale',
+                  'id_age',
+                  'age_disparity',
+                  'children_not_partner',
+                  )
+
+# initial weed-out maps 2 to zero as a 'no' response
+# maps 3, 9, and unreliable/error codes due to unreliable or out of scope responses
+# maps 4 to an affirmative 1 response. correlates to 'yes but not in past year'
+BINARY_STEPS_ALL = (((2, 3, 9) + SENTINEL_CODES, 0),
+                    ((4,), 1),
+                    )
+
+RECODES_ALL = {
+    # alters response of question to an affirmative binary if more than one gun in home
+    'guns_in_home': ((tuple(range(2, 16)), 1),),
+    # bins 2+ children into one category of '2'
+    'num_children': ((tuple(range(2, 13)), 2),),
+    # bins multiple abusers, maps unavailable info to zero
+    'num_abusers': (((2, 3), 2),
+                    ((9,), 0)),
+    # remaps beaten while pregnant to a binary
+    'beaten_while_pregnant': ((tuple(range(2, 13)), 0),),
+    # remaps responses to age disparity
+    'age_disparity': (((1, 999), 0),
+                      ((2,), 1),
+                      ((3,), 2),
+                      ((4,), -1),
+                      ((5,), -2),
+                      ((6,), -3)),
+    'power_scale': (((999,), 0),),
+    }
+
+# columns of dfb that are yes/no answers
+BINARY_RECID = ('gun_fired',
+                'anyone_high',
+                'safe_place',
+                'forced_illegal',
+                'life_danger',
+                'talk_about_it',
+                )
+
+# initial weed-out maps 2 to zero as a 'no' response
+# maps 888, 999, 9999 and unreliable/error codes due to unreliable or out of scope responses
+BINARY_STEPS_RECID = (((2, 888, 999, 9999), 0),)
+
+# applied to every dfb column without an entry in RECODES_RECID
+DEFAULT_STEPS_RECID = (((888, 99, 999, 9999), 0),)
+
+RECODES_RECID = {
+    'order_protection': (((2, 3, 999, 9999), 0),),
+    'left_or_not': ((tuple(range(11, 20)), 1),
+                    ((21, 22, 31, 32, 33, 41, 42, 43, 44, 45, 46, 99), 0)),
+    'medical_staff_helpful': (((41, 7777, 99999, 9999), 0),),
+    'level_severity': (((9,), 0),),
+    }
+
+# value ranges wider than this are recoded through np.unique instead of a lookup table
+MAX_LOOKUP_SPAN = 1 << 20
+
+
+def make_recode_spec_all(columns):
+    '''
+    takes the column names of a renamed dfa and returns
+    a dictionary of column name to recoding steps
+    '''
+    spec = {}
+    for col in columns:
+        if col in ('CASEID', 'id'):
+            continue
+        steps = () if col in NON_BINARY_ALL else BINARY_STEPS_ALL
+        steps += RECODES_ALL.get(col, ())
+        if steps:
+            spec[col] = steps
+    return spec
+
+
+def make_recode_spec_recid(columns):
+    '''
+    takes the column names of a renamed dfb and returns
+    a dictionary of column name to recoding steps
+    '''
+    spec = {}
+    for col in columns:
+        if col in ('CASEID', 'id'):
+            continue
+        steps = BINARY_STEPS_RECID if col in BINARY_RECID else ()
+        spec[col] = steps + RECODES_RECID.get(col, DEFAULT_STEPS_RECID)
+    return spec
+
+
+def compile_recode(steps, values):
+    '''
+    takes recoding steps and a sorted array of distinct values and
+    returns the array of what each value is recoded to
+    '''
+    out = np.array(values, dtype=np.int64)
+    for codes, value in steps:
+        out[np.isin(out, codes)] = value
+    return out
+
+
+def recode_values(values, steps):
+    '''
+    returns a recoded copy of an integer numpy array (of any shape) in one
+    vectorized pass: the steps are compiled into a lookup table over the
+    array's value range and every element is mapped with a single index operation
+    '''
+    if values.size == 0:
+        return values.copy()
+    low, high = min(int(values.min()), 0), int(values.max())
+    if high - low <= MAX_LOOKUP_SPAN:
+        lookup = _fit_dtype(compile_recode(steps, np.arange(low, high + 1)), values.dtype)
+        out = lookup[values] if low == 0 else lookup[values.astype(np.intp) - low]
+    else:
+        uniques, inverse = np.unique(values, return_inverse=True)
+        lookup = _fit_dtype(compile_recode(steps, uniques), values.dtype)
+        out = lookup[inverse.reshape(values.shape)]
+    return out
+
+
+def _fit_dtype(lookup, dtype):
+    # keeps the recoded values in the column's dtype whenever they fit
+    info = np.iinfo(dtype)
+    if lookup.min() >= info.min and lookup.max() <= info.max:
+        return lookup.astype(dtype)
+    return lookup
+
+
+def recode_series(series, steps):
+    '''
+    returns a recoded copy of a series; integer series go through
+    recode_values, anything else falls back to chained Series.replace calls
+    '''
+    if not np.issubdtype(series.dtype, np.integer):
+        for codes, value in steps:
+            series = series.replace(list(codes), value)
+        return series
+    return pd.Series(recode_values(series.to_numpy(), steps),
+                     index=series.index, name=series.name)
+
+
+def apply_recode(df, spec):
+    '''
+    recodes the columns of df listed in spec in place.
+    integer columns of the same dtype sharing the same steps are recoded
+    together as one 2-d block; other columns go through recode_series.
+    '''
+    blocks = {}
+    for col, steps in spec.items():
+        if col not in df.columns or not steps:
+            continue
+        if np.issubdtype(df[col].dtype, np.integer):
+            blocks.setdefault((steps, df[col].dtype), []).append(col)
+        else:
+            df[col] = recode_series(df[col], steps)
+    for (steps, dtype), cols in blocks.items():
+        # transposed so each column's values are contiguous rows of the block
+        out = recode_values(df[cols].to_numpy().T, steps)
+        for col, values in zip(cols, out):
+            df[col] = values
+
+
+def recode(df, spec):
+    '''
+    returns a copy of df with every column in spec (a dictionary of
+    column name to recoding steps) recoded
+    '''
+    df = df.copy()
+    apply_recode(df, spec)
+    return df
 
 # ===========
 # PREPARATION
@@ -33,27 +272,40 @@ def make_repeat_series(df10):
     repeat_series = df10.groupby('CASEID').INCIDENT.count()
     return repeat_series
 
-def over_1(repeat_series):
+def over_1(repeat_series, threshold=1):
     '''
     takes a pandas series and tests for a value to put in a list of caseIDs 
-    that are repeat offenses
+    that are repeat offenses (more than threshold incidents, default 1)
     '''
-    repeat_cases = []
-    for case, inc_num in enumerate(repeat_series):
-        if inc_num > 1:
-            repeat_cases.append(repeat_series.index[case])
-    return repeat_cases
+    return list(repeat_series.index[repeat_series > threshold])
 
-def get_repeat_case(val):
+def get_repeat_case(val, df10=None):
     '''
     takes a value and establishes if it meets criteria to be in repeat offenses
+    df10: incident-level dataframe, defaults to get_incidents()
+    prefer add_recid_column when labelling a whole dataframe
     '''
+    if df10 is None:
+        df10 = get_incidents()
     repeat_cases = over_1(make_repeat_series(df10))
     if val in repeat_cases:
         return 1
     else:
         return 0
 
+def add_recid_column(dfb, incidents=None, threshold=1):
+    '''
+    takes a dataframe with a CASEID column and returns a copy with a RECID column:
+    1 if the case has more than threshold incidents in the incident-level
+    dataframe (incidents, defaults to get_incidents()), else 0.
+    incident counts are computed once and every case is labelled in one lookup.
+    '''
+    if incidents is None:
+        incidents = get_incidents()
+    repeat_series = make_repeat_series(incidents)
+    repeat_cases = repeat_series.index[repeat_series > threshold]
+    return dfb.assign(RECID=dfb.CASEID.isin(repeat_cases).astype('int8'))
+
 def value_counts(dataframe):
     ''' 
     assesses that column is not the primary key and presents values
@@ -68,134 +320,109 @@ def value_counts(dataframe):
             print(dataframe[col].value_counts(sort=False))
         print('\n-------------------------------------------------------------\n')
 
+RENAME_ALL = {'CASEID': 'id',
+              'ABUSED': 'abuse_past_year',
+              'SCRSTATR': 'abuse_status',
+              'LENGTHC1': 'length_relationship',
+              'C1SITUAT': 'partner_abusive',
+              'PABUSE': 'num_abusers',
+              'D3RCHILT': 'num_children',
+              'E13PRGNT': 'pregnant',
+              'N7PREGNT': 'beaten_while_pregnant',
+              'TOTSUPRT': 'support_score',
+              'G1NUMBER': 'guns_in_home',
+              'H1JEALUS': 'jealous_past_year',
+              'H2LIMIT': 'limit_family_contact',
+              'H3KNOWNG': 'location_tracking',
+              'J1HIT': 'threat_hit',
+              'J2THROWN': 'threat_object',
+              'J3PUSH': 'push_shove',
+              'J4SLAP': 'slap',
+              'J5KICK': 'kick_punch',
+              'J6OBJECT': 'hit_object',
+              'J7BEAT': 'beaten',
+              'J8CHOKE': 'choked',
+              'J9KNIFE': 'threat_knife',
+              'J10GUN': 'threat_gun',
+              'J11SEX': 'rape_with_threat',
+              'POWER': 'power_scale',
+              'HARASS': 'harass_scale',
+              'B1AGE': 'id_age',
+              'AGEDISP': 'age_disparity',
+              'STDETAI': 'children_not_partner',
+              'SAMESEXR': 'same_sex_relationship',
+              'N11DRUGS': 'partner_drug_use',
+              'N12ALCHL': 'partner_alcohol_use',
+              'N13SUHIM': 'threat_suicide',
+              'N16CHILD': 'partner_reported_child_abuse',
+              'N17ARRST': 'partner_arrested',
+              'N1FRQNCY': 'violence_increased',
+              'N2SVRITY': 'severity_increased',
+              'N3WEAPON': 'weapon_ever',
+              'N4CHOKE': 'choked_ever',
+              'N5SEX': 'rape_ever',
+              'N6CONTRL': 'controlled_ever',
+              'N8JEALUS': 'jealous',
+              'N10CPBLE': 'capable_murder',
+              'RECID': 'reassault',
+              }
+
 def rename_columns_all(dfa):
     '''
     takes in selected dataframe and renames columns to intuitive non-capitalized titles
     '''
     df = dfa
-    return df.rename(columns={'CASEID': 'id',
-                              'ABUSED': 'abuse_past_year',
-                              'SCRSTATR': 'abuse_status',
-                              'LENGTHC1': 'length_relationship',
-                              'C1SITUAT': 'partner_abusive',
-                              'PABUSE': 'num_abusers',
-                              'D3RCHILT': 'num_children',
-                              'E13PRGNT': 'pregnant',
-                              'N7PREGNT': 'beaten_while_pregnant',
-                              'TOTSUPRT': 'support_score',
-                              'G1NUMBER': 'guns_in_home',
-                              'H1JEALUS': 'jealous_past_year',
-                              'H2LIMIT': 'limit_family_contact',
-                              'H3KNOWNG': 'location_tracking',
-                              'J1HIT': 'threat_hit',
-                              'J2THROWN': 'threat_object',
-                              'J3PUSH': 'push_shove',
-                              'J4SLAP': 'slap',
-                              'J5KICK': 'kick_punch',
-                              'J6OBJECT': 'hit_object',
-                              'J7BEAT': 'beaten',
-                              'J8CHOKE': 'choked',
-                              'J9KNIFE': 'threat_knife',
-                              'J10GUN': 'threat_gun',
-                              'J11SEX': 'rape_with_threat',
-                              'POWER': 'power_scale',
-                              'HARASS': 'harass_scale',
-                              'B1AGE': 'id_age',
-                              'AGEDISP': 'age_disparity',
-                              'STDETAI': 'children_not_partner',
-                              'SAMESEXR': 'same_sex_relationship',
-                              'N11DRUGS': 'partner_drug_use',
-                              'N12ALCHL': 'partner_alcohol_use',
-                              'N13SUHIM': 'threat_suicide',
-                              'N16CHILD': 'partner_reported_child_abuse',
-                              'N17ARRST': 'partner_arrested',
-                              'N1FRQNCY': 'violence_increased',
-                              'N2SVRITY': 'severity_increased',
-                              'N3WEAPON': 'weapon_ever',
-                              'N4CHOKE': 'choked_ever',
-                              'N5SEX': 'rape_ever',
-                              'N6CONTRL': 'controlled_ever',
-                              'N8JEALUS': 'jealous',
-                              'N10CPBLE': 'capable_murder',
-                              'RECID': 'reassault'
-                              })
+    return df.rename(columns=RENAME_ALL)
 
 def replace_nonvals_all(df):
     '''
     assesses values in column of a dataframe are in numerical format and replaces
     any missing values as per our data dictionary with an imputed zero value.
+    (see RECODES_ALL for the rules)
     '''
-    for col in df:
-        if col in(['CASEID', 'id']):
-            pass
-        elif col not in(['length_relationship',
-                         'num_abusers',
-                         'num_children',
-                         'power_scale',
-                         'harass_scale',
-                         'id_age',
-                         'age_disparity',
-                         'children_not_partner']):
-            # initial weed-out maps 2 to zero as a 'no' response
-            # maps 3, 9, and unreliable/error codes due to unreliable or out of scope responses
-            df[col].replace([2, 3, 9, 555, 666, 777, 888,
-                             999, 9999], 0, inplace=True)
-            # maps 4 to an affirmative 1 response. correlates to 'yes but not in past year'
-            df[col].replace(4, 1, inplace=True)
-        if col == 'guns_in_home':
-            # alters response of question to an affirmative binary if more than one gun in home
-            df[col].replace([2, 3, 4, 5, 6, 7, 8, 9, 10, 11,
-                             12, 13, 14, 15], 1, inplace=True)
-        elif col == 'num_children':
-            # bins 2+ children into one category of '2'
-            df[col].replace(
-                [2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12], 2, inplace=True)
-        elif col == 'num_abusers':
-            # bins multiple abusers, maps unavailable info to zero
-            df[col].replace([2, 3], 2, inplace=True)
-            df[col].replace(9, 0, inplace=True)
-        elif col == 'beaten_while_pregnant':
-            # remaps beaten while pregnant to a binary
-            df[col].replace(
-                [2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12], 0, inplace=True)
-        elif col == 'age_disparity':
-            # remaps responses to age disparity
-            df[col].replace([1, 999], 0, inplace=True)
-            df[col].replace(2, 1, inplace=True)
-            df[col].replace(3, 2, inplace=True)
-            df[col].replace(4, -1, inplace=True)
-            df[col].replace(5, -2, inplace=True)
-            df[col].replace(6, -3, inplace=True)
-        elif col == 'power_scale':
-            df[col].replace(999, 0, inplace=True)
-
-def get_nulls_by_column(df):
-    '''
-    gives analysis of dataframe and prints out nulls by column
-    '''
-    sum_nulls_col = df.isna().sum()
-    percent_nulls_col = df.isna().sum()/len(df.columns)
-    nulls_by_col = pd.concat([sum_nulls_col, percent_nulls_col], names=[
-                             'sum_nulls_col', 'percent_nulls_col'], axis=1)
-    nulls_by_col['sum_nulls'] = nulls_by_col[0]
-    nulls_by_col['nulls_by_percent'] = nulls_by_col[1]
-    nulls_by_col.drop(columns=[0, 1], inplace=True)
-    nulls_by_col = nulls_by_col.loc[~(nulls_by_col == 0).all(axis=1)]
-    print(nulls_by_col)
-
-def get_nulls_by_row(df):
-    '''
-    gives analysis of dataframe and prints pandas dataframe of nulls by row
-    '''
-    df.reset_index(inplace=True, drop=True)
-    rows = len(df.index)
-    nulls_by_row = pd.DataFrame
-    for ind in range(rows):
-        null_vals = df.loc[ind].isna().sum()
-        percent = (null_vals/(len(df.loc[ind]))*100)
-        if null_vals > 0:
+    apply_recode(df, make_recode_spec_all(df.columns))
+
+def get_null_profile(df):
+    '''
+    computes the null counts of a dataframe from a single isna() matrix and
+    returns two pandas dataframes: nulls by row and nulls by column,
+    each with a count and a percent (0-100) of nulls
+    '''
+    nulls = df.isna().to_numpy()
+    num_rows, num_cols = nulls.shape
+    sum_nulls_row = nulls.sum(axis=1)
+    sum_nulls_col = nulls.sum(axis=0)
+    nulls_by_row = pd.DataFrame({'sum_nulls': sum_nulls_row,
+                                 'nulls_by_percent': sum_nulls_row / max(num_cols, 1) * 100},
+                                index=df.index)
+    nulls_by_col = pd.DataFrame({'sum_nulls': sum_nulls_col,
+                                 'nulls_by_percent': sum_nulls_col / max(num_rows, 1) * 100},
+                                index=df.columns)
+    return nulls_by_row, nulls_by_col
+
+def get_nulls_by_column(df, show=True):
+    '''
+    gives analysis of dataframe and returns (and prints, if show) nulls by column
+    for the columns that have any
+    '''
+    nulls_by_col = get_null_profile(df)[1]
+    nulls_by_col = nulls_by_col[nulls_by_col.sum_nulls > 0]
+    if show:
+        print(nulls_by_col)
+    return nulls_by_col
+
+def get_nulls_by_row(df, show=True):
+    '''
+    gives analysis of dataframe and returns (and prints, if show) nulls by row
+    for the rows that have any; the dataframe's index is left untouched
+    '''
+    nulls_by_row = get_null_profile(df)[0]
+    nulls_by_row = nulls_by_row[nulls_by_row.sum_nulls > 0]
+    if show:
+        for ind, null_vals, percent in nulls_by_row.itertuples():
             print('row: {} count nulls: {}, percent nulls in row: {:.2f}.'.format(
                 ind, null_vals, percent))
+    return nulls_by_row
 
 def handle_missing_threshold(df, prop_required_column=.3, prop_required_row=.9):
     '''
@@ -229,94 +456,54 @@ def summarize_data(df):
     value_counts(df)
 
 # brief note reminder on creating recidivism column:
-# dfb['RECID'] = dfb.CASEID.apply(get_repeat_case)
+# dfb = add_recid_column(dfb)
+
+RENAME_RECID = {'CASEID': 'id',
+                'M5FIRED': 'gun_fired',
+                'M11HIGH': 'anyone_high',
+                'M35SAFE': 'safe_place',
+                'M41ILLGL': 'forced_illegal',
+                'M42DAGRR': 'life_danger',
+                'M13TALKR': 'talk_about_it',
+                'M32OTHER': 'left_or_not',
+                'M27HOW': 'medical_staff_helpful',
+                'M30ARRES': 'perp_arrested_ever',
+                'M31HOW': 'police_resp',
+                'M38ORDER': 'order_protection',
+                'SEVERER': 'level_severity',
+                'TOTINCR': 'num_incidents',
+                'THREATR': 'num_threats',
+                'SLAPR': 'num_slapping',
+                'PUNCHR': 'num_punching',
+                'BEATR': 'num_beating',
+                'UWEAPON': 'num_weapon',
+                'FORCEDR': 'num_forced_sex',
+                'MISCARR': 'miscarriage_resulted',
+                'RESTRAIN': 'restrained_by_perp',
+                'CHOKED': 'num_choked',
+                'NDRUNK': 'num_perp_drunk',
+                'RDRUNK': 'num_woman_drunk',
+                'BOTHDRUN': 'num_both_drunk',
+                'NDRUGS': 'num_perp_drugs',
+                'RDRUGS': 'num_woman_drugs',
+                'BOTHDRUG': 'num_both_drugs',
+                'RECID': 'reassault',
+                }
 
 def rename_columns_recid(dfb):
     '''
     takes in selected dataframe and renames columns to intuitive non-capitalized titles
     '''
     df = dfb
-    return df.rename(columns={'CASEID': 'id',
-                              'M5FIRED': 'gun_fired',
-                              'M11HIGH': 'anyone_high',
-                              'M35SAFE': 'safe_place',
-                              'M41ILLGL': 'forced_illegal',
-                              'M42DAGRR': 'life_danger',
-                              'M13TALKR': 'talk_about_it',
-                              'M32OTHER': 'left_or_not',
-                              'M27HOW': 'medical_staff_helpful',
-                              'M30ARRES': 'perp_arrested_ever',
-                              'M31HOW': 'police_resp',
-                              'M38ORDER': 'order_protection',
-                              'SEVERER': 'level_severity',
-                              'TOTINCR': 'num_incidents',
-                              'THREATR': 'num_threats',
-                              'SLAPR': 'num_slapping',
-                              'PUNCHR': 'num_punching',
-                              'BEATR': 'num_beating',
-                              'UWEAPON': 'num_weapon',
-                              'FORCEDR': 'num_forced_sex',
-                              'MISCARR': 'miscarriage_resulted',
-                              'RESTRAIN': 'restrained_by_perp',
-                              'CHOKED': 'num_choked',
-                              'NDRUNK': 'num_perp_drunk',
-                              'RDRUNK': 'num_woman_drunk',
-                              'BOTHDRUN': 'num_both_drunk',
-                              'NDRUGS': 'num_perp_drugs',
-                              'RDRUGS': 'num_woman_drugs',
-                              'BOTHDRUG': 'num_both_drugs',
-                              'RECID': 'reassault'
-                              })
+    return df.rename(columns=RENAME_RECID)
 
 def replace_nonvals_recid(dfb):
     '''
     assesses values in column of dataframe with reassault cases are in numerical format and replaces
     any missing values as per our data dictionary with an imputed zero value.
+    (see RECODES_RECID for the rules)
     '''
-    df = dfb
-    for col in df:
-        if col in(['CASEID', 'id']):
-            pass
-        elif col in(['gun_fired',
-                     'anyone_high',
-                     'safe_place',
-                     'forced_illegal',
-                     'life_danger',
-                     'talk_about_it']):
-            # initial weed-out maps 2 to zero as a 'no' response
-            # maps 888, 999, 9999 and unreliable/error codes due to unreliable or out of scope responses
-            df[col].replace([2, 888, 999, 9999], 0, inplace=True)
-        if col == 'order_protection':
-            df[col].replace([2, 3, 999, 9999], 0, inplace=True)
-        elif col == 'left_or_not':
-            df[col].replace(
-                [11, 12, 13, 14, 15, 16, 17, 18, 19], 1, inplace=True)
-            df[col].replace([21, 22, 31, 32, 33, 41, 42, 43,
-                             44, 45, 46, 99], 0, inplace=True)
-        elif col == 'medical_staff_helpful':
-            df[col].replace([41, 7777, 99999, 9999], 0, inplace=True)
-        elif col == 'level_severity':
-            df[col].replace(9, 0, inplace=True)
-        else:
-            df[col].replace([888, 99, 999, 9999], 0, inplace=True)
-
-        # elif col == 'perp_arrested_ever':
-        #     df[col].replace(2, 'removed', inplace=True)
-        #     df[col].replace(3, 0, inplace=True)
-        #     df[col].replace(999, 'missing', inplace=True)
-        # elif col == 'police_resp':
-        #     df[col].replace(777, 'na', inplace=True)
-        #     df[col].replace(999, 'missing', inplace=True)
-        # elif col == 'order_protection':
-        #     df[col].replace([2, 3], 0, inplace=True)
-        #     df[col].replace([999, 9999], 'missing/unknown', inplace=True)
-
-        # elif col == 'num_incidents':
-        #     df[col].replace(999, 'missing', inplace=True)
-        # elif col == 'num_threats':
-        #     df[col].replace(999, 'missing', inplace=True)
-        # elif col == 'num_slapping':
-        #     df[col].replace(999, 'missing', inplace=True)
+    apply_recode(dfb, make_recode_spec_recid(dfb.columns))
 
 def merge_all_recid(dfa, dfb):
     '''
@@ -327,35 +514,38 @@ def merge_all_recid(dfa, dfb):
     df1 = dfa
     df2 = dfb
     dfa_abused = df1[df1.abuse_past_year == 1]
-    df_so_very_large = dfa_abused.merge(right=df2, on='id')
+    df_so_very_large = acquire.merge_all([dfa_abused, df2], on='id')
     return df_so_very_large
 
+# columns deemed not necessary after feature selection
+DROP_COLS = ['guns_in_home',
+             'threat_hit',
+             'beaten',
+             'choked',
+             'threat_knife',
+             'threat_gun',
+             'rape_with_threat',
+             'partner_drug_use',
+             'partner_alcohol_use',
+             'weapon_ever',
+             'choked_ever',
+             'jealous_past_year',
+             'gun_fired',
+             'medical_staff_helpful',
+             'police_resp',
+             'order_protection',
+             'num_woman_drunk',
+             'num_perp_drunk',
+             'num_woman_drugs',
+             'num_perp_drugs',
+             ]
+
 def drop_cols_df_large(df):
     '''
     This function takes into account feature selection and drops columns 
     that are deemed not necessary from the joined greater dataframe
     '''
-    df = df.drop(columns=['guns_in_home',
-                          'threat_hit',
-                          'beaten',
-                          'choked',
-                          'threat_knife',
-                          'threat_gun',
-                          'rape_with_threat',
-                          'partner_drug_use',
-                          'partner_alcohol_use',
-                          'weapon_ever',
-                          'choked_ever',
-                          'jealous_past_year',
-                          'gun_fired',
-                          'medical_staff_helpful',
-                          'police_resp',
-                          'order_protection',
-                          'num_woman_drunk',
-                          'num_perp_drunk',
-                          'num_woman_drugs',
-                          'num_perp_drugs'
-                          ])
+    df = df.drop(columns=DROP_COLS)
     return df
 
 def remove_phase_2_features(features):
@@ -396,6 +586,206 @@ def remove_phase_2_features(features):
     if 'severity_increased' in features:
         features.remove('severity_increased')
 
+def prepare_records(df):
+    '''
+    takes raw survey records with their original column names (e.g. a chunk of
+    an intake extract) and returns a copy renamed and recoded with the same rules
+    as rename_columns_all / rename_columns_recid and replace_nonvals_all / replace_nonvals_recid
+    '''
+    df = df.rename(columns={**RENAME_RECID, **RENAME_ALL})
+    all_cols = set(RENAME_ALL.values())
+    spec = make_recode_spec_recid([col for col in df.columns
+                                   if col in RENAME_RECID.values() and col not in all_cols])
+    spec.update(make_recode_spec_all([col for col in df.columns if col in all_cols]))
+    apply_recode(df, spec)
+    return df
+
+def get_feature_recoders(features):
+    '''
+    takes a list of prepared feature names and returns a dictionary of
+    feature name to (original column name, recoding steps), for recoding
+    a single raw record without building a dataframe (see recode_value)
+    '''
+    raw_names = {name: raw for raw, name in {**RENAME_RECID, **RENAME_ALL}.items()}
+    all_cols = set(RENAME_ALL.values())
+    spec = make_recode_spec_recid([feat for feat in features
+                                   if feat in RENAME_RECID.values() and feat not in all_cols])
+    spec.update(make_recode_spec_all([feat for feat in features if feat in all_cols]))
+    return {feat: (raw_names.get(feat, feat), spec.get(feat, ())) for feat in features}
+
+def recode_value(value, steps):
+    '''
+    applies recoding steps to a single value, like recode_values does to an array
+    '''
+    for codes, new_value in steps:
+        if value in codes:
+            value = new_value
+    return value
+
+# ========
+# PIPELINE
+# ========
+
+class Pipeline:
+    '''
+    a sequence of preparation steps applied to one dataframe.
+    each step is a function called with the working frame (plus keyword
+    arguments) and a mode saying what it does with that frame:
+    'inplace': mutates it; the return value is ignored
+    'copy': returns a new frame that shares no data with it
+    'view': returns a new frame that may share data with it
+
+    run() copies the caller's frame at most once, right before the first
+    in-place step that would otherwise modify it, and always returns a
+    frame that shares no data with its input.
+    '''
+    MODES = ('inplace', 'copy', 'view')
+
+    def __init__(self, steps=None):
+        self.steps = []
+        for step in steps or []:
+            self.add(*step)
+
+    def add(self, func, mode='copy', **kwargs):
+        '''
+        appends a step and returns the pipeline so calls can be chained
+        '''
+        if mode not in self.MODES:
+            raise ValueError('mode must be one of {}, got {!r}'.format(self.MODES, mode))
+        self.steps.append((func, mode, kwargs))
+        return self
+
+    def plan(self):
+        '''
+        returns the step names in order, with 'copy' wherever run() makes its own copy
+        '''
+        planned = []
+        owned = False
+        for func, mode, kwargs in self.steps:
+            if mode == 'inplace' and not owned:
+                planned.append('copy')
+                owned = True
+            planned.append(getattr(func, '__name__', repr(func)))
+            owned = owned or mode == 'copy'
+        if not owned:
+            planned.append('copy')
+        return planned
+
+    def run(self, df):
+        '''
+        applies every step to df and returns the prepared frame
+        '''
+        owned = False
+        for func, mode, kwargs in self.steps:
+            if mode == 'inplace':
+                if not owned:
+                    df = df.copy()
+                    owned = True
+                func(df, **kwargs)
+            else:
+                df = func(df, **kwargs)
+                owned = owned or mode == 'copy'
+        return df if owned else df.copy()
+
+
+def rename_view(df, columns):
+    '''
+    renames columns without copying the underlying data
+    '''
+    return df.rename(columns=columns, copy=False)
+
+def drop_inplace(df, columns):
+    '''
+    drops columns from df in place
+    '''
+    df.drop(columns=columns, inplace=True)
+
+def make_recid_pipeline(incidents=None, threshold=1):
+    '''
+    returns the Pipeline that prepares dfb: label recidivism, rename, recode
+    '''
+    return (Pipeline()
+            .add(add_recid_column, 'copy', incidents=incidents, threshold=threshold)
+            .add(rename_view, 'view', columns=RENAME_RECID)
+            .add(replace_nonvals_recid, 'inplace'))
+
+def make_all_pipeline(dfb, drop_cols=DROP_COLS, prop_required_column=.3, prop_required_row=.9):
+    '''
+    returns the Pipeline that prepares dfa and joins it with an already
+    prepared dfb: rename, recode, merge, drop, threshold
+    '''
+    return (Pipeline()
+            .add(rename_view, 'view', columns=RENAME_ALL)
+            .add(replace_nonvals_all, 'inplace')
+            .add(merge_all_recid, 'copy', dfb=dfb)
+            .add(drop_inplace, 'inplace', columns=drop_cols)
+            .add(handle_missing_threshold, 'inplace',
+                 prop_required_column=prop_required_column,
+                 prop_required_row=prop_required_row))
+
+def prepare_data(dfa, dfb, incidents=None, threshold=1, drop_cols=DROP_COLS,
+                 prop_required_column=.3, prop_required_row=.9):
+    '''
+    runs the whole preparation in one call on the two dataframes
+    returned by acquire.get_data and returns the modeling dataframe;
+    dfa and dfb are not modified
+    '''
+    dfb = make_recid_pipeline(incidents, threshold).run(dfb)
+    return make_all_pipeline(dfb, drop_cols, prop_required_column, prop_required_row).run(dfa)
+
+def get_prepared_key(threshold=1, drop_cols=DROP_COLS, prop_required_column=.3, prop_required_row=.9,
+                     incidents=None):
+    '''
+    returns a hash of everything the modeling dataframe depends on:
+    the input files (path, size, mtime), the incident table when it is not
+    data10.csv (incidents, or one given to set_incidents; see
+    get_incidents_fingerprint), the selected columns,
+    the renaming and recoding rules and the preparation parameters
+    '''
+    filenames = [filename for filename, columns in acquire.SURVEY_SPECS] + ['data10.csv']
+    config = ([acquire.get_cache_dir(acquire.DATA_PATH + filename) for filename in filenames],
+              acquire.SURVEY_SPECS,
+              acquire.WIDE_COLS,
+              RENAME_ALL,
+              RENAME_RECID,
+              SENTINEL_CODES,
+              NON_BINARY_ALL,
+              BINARY_STEPS_ALL,
+              RECODES_ALL,
+              BINARY_RECID,
+              BINARY_STEPS_RECID,
+              DEFAULT_STEPS_RECID,
+              RECODES_RECID,
+              threshold,
+              list(drop_cols),
+              prop_required_column,
+              prop_required_row,
+              get_incidents_fingerprint(incidents))
+    return hashlib.sha1(repr(config).encode('utf-8')).hexdigest()[:16]
+
+def get_prepared_data(threshold=1, drop_cols=DROP_COLS, prop_required_column=.3,
+                      prop_required_row=.9, incidents=None, use_cache=True):
+    '''
+    returns the modeling dataframe (acquire.get_data followed by prepare_data,
+    with recidivism labels from incidents, or get_incidents() if None).
+    the result is stored under acquire.CACHE_PATH and loaded from there
+    as long as get_prepared_key is unchanged; use_cache=False rebuilds it.
+    only the most recently built configuration is kept.
+    the cached frame comes back with a fresh RangeIndex.
+    '''
+    key = get_prepared_key(threshold, drop_cols, prop_required_column, prop_required_row,
+                           incidents)
+    cache_dir = os.path.join(acquire.CACHE_PATH, 'prepared-' + key)
+    if use_cache and os.path.isdir(cache_dir):
+        return acquire.load_cache(cache_dir)
+    dfa, dfb = acquire.get_data()
+    df = prepare_data(dfa, dfb, incidents=incidents, threshold=threshold, drop_cols=drop_cols,
+                      prop_required_column=prop_required_column,
+                      prop_required_row=prop_required_row)
+    if use_cache:
+        acquire.write_cache(df, cache_dir)
+    return df
+
 # ==================================================
 # MAIN
 # ==================================================
@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+
+"""
+This script originally written by the CodeUp Queers
+group for their capstone project in 2019 at CodeUp.
+Used with permission.
+
+1. Ednalyn C. De Dios
+2. Jesse Ruiz
+3. Madeleine Capper
+
+"""
+
+# ===========
+# ENVIRONMENT
+# ===========
+
+import asyncio
+import json
+import math
+import numbers
+import os
+import sys
+import time
+
+import numpy as np
+
+import model
+import prepare
+
+# largest request body the server reads, in bytes
+MAX_BODY = 1 << 20
+
+# ======
+# MODELS
+# ======
+
+class ScoringModel:
+    '''
+    A registered model kept warm for single-record scoring:
+    the compiled arrays saved with the model are memory-mapped (or the model
+    is compiled with model.compile_model if it has none) and every feature
+    carries the recoding steps that prepare.py applies to its raw survey column
+    '''
+    def __init__(self, model_dir):
+        self.name = os.path.basename(os.path.normpath(model_dir))
+        self.evaluator = model.load_compiled(os.path.join(model_dir, 'compiled'))
+        if self.evaluator is None:
+            result = model.load_model(model_dir)
+            if result is None:
+                raise FileNotFoundError('no registered model in {}'.format(model_dir))
+            self.evaluator = model.compile_model(result.model)
+        self.features = model.load_features(model_dir)
+        classes = list(self.evaluator.classes_)
+        self.positive = classes.index(1) if 1 in classes else -1
+        self.recoders = prepare.get_feature_recoders(self.features)
+        # score a dummy row now, so one-time costs are paid at load, not by the first request
+        self.score_rows(np.zeros((1, len(self.features))))
+
+    def to_row(self, record):
+        '''
+        turns a record (a dictionary keyed by prepared feature names, whose
+        values are used as they are, or by original column names, whose values
+        are recoded) into a row of feature values;
+        raises KeyError for a missing feature and ValueError for a value that
+        is not a finite number (e.g. null)
+        '''
+        row = np.empty(len(self.features))
+        for i, feat in enumerate(self.features):
+            raw, steps = self.recoders[feat]
+            if feat in record:
+                value = record[feat]
+            elif raw in record:
+                value = prepare.recode_value(check_value(record[raw], raw), steps)
+            else:
+                raise KeyError('record is missing {} ({})'.format(feat, raw))
+            row[i] = check_value(value, feat)
+        return row
+
+    def score_rows(self, rows):
+        '''
+        returns the probability of reassault for every row of a 2-d array
+        '''
+        return self.evaluator.predict_proba(rows)[:, self.positive]
+
+
+def check_value(value, name):
+    '''
+    returns value if it is a finite number, else raises ValueError
+    '''
+    if (isinstance(value, bool) or not isinstance(value, numbers.Real)
+            or not math.isfinite(value)):
+        raise ValueError('{} must be a finite number, got {!r}'.format(name, value))
+    return value
+
+
+class MicroBatcher:
+    '''
+    Collects rows from concurrent requests and scores them together:
+    the first waiting row starts a batch, which is scored once it holds
+    max_batch rows or max_wait seconds have passed
+    '''
+    def __init__(self, scoring_model, max_batch=64, max_wait=0.002):
+        self.scoring_model = scoring_model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def score(self, row):
+        '''
+        queues one row and waits for its probability
+        '''
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((row, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            rows = np.vstack([row for row, future in batch])
+            try:
+                probas = self.scoring_model.score_rows(rows)
+            except Exception as err:
+                for row, future in batch:
+                    if not future.done():
+                        future.set_exception(err)
+                continue
+            for (row, future), proba in zip(batch, probas):
+                if not future.done():
+                    future.set_result(float(proba))
+
+# ======
+# SERVER
+# ======
+
+class ScoringServer:
+    '''
+    A small asyncio HTTP/1.1 server (keep-alive, JSON) for scoring single records.
+
+    POST /score with {"record": {...}} or {"records": [{...}, ...]},
+    plus an optional "model" naming one of the loaded model directories
+    (the first one by default), answers {"model": ..., "proba": ...}.
+    GET /health lists the loaded models.
+    Bodies longer than max_body bytes are refused (413) and the connection closed.
+    '''
+    def __init__(self, model_dirs, max_batch=64, max_wait=0.002, max_body=MAX_BODY):
+        self.max_body = max_body
+        self.models = {}
+        for model_dir in model_dirs:
+            scoring_model = ScoringModel(model_dir)
+            self.models[scoring_model.name] = MicroBatcher(scoring_model, max_batch, max_wait)
+        self.default = next(iter(self.models))
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=8080):
+        for batcher in self.models.values():
+            batcher.start()
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for batcher in self.models.values():
+            await batcher.stop()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path = request_line.decode('latin-1').split()[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = headers.get('content-length', '0')
+                if not length.isdigit():
+                    await self.respond(writer, '400 Bad Request', {'error': 'bad content-length'})
+                    break
+                if int(length) > self.max_body:
+                    await self.respond(writer, '413 Payload Too Large',
+                                       {'error': 'body over {} bytes'.format(self.max_body)})
+                    break
+                body = await reader.readexactly(int(length))
+                status, payload = await self.route(method, path, body)
+                await self.respond(writer, status, payload)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, payload):
+        data = json.dumps(payload, allow_nan=False).encode('utf-8')
+        writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\n'
+                     'Content-Length: {}\r\n\r\n'.format(status, len(data)).encode('latin-1') + data)
+        await writer.drain()
+
+    async def route(self, method, path, body):
+        if method == 'GET' and path == '/health':
+            return '200 OK', {'models': list(self.models)}
+        if method != 'POST' or path != '/score':
+            return '404 Not Found', {'error': 'use POST /score or GET /health'}
+        try:
+            request = json.loads(body or b'{}')
+            batcher = self.models[request.get('model', self.default)]
+            if 'records' in request:
+                rows = [batcher.scoring_model.to_row(record) for record in request['records']]
+                proba = list(await asyncio.gather(*[batcher.score(row) for row in rows]))
+            else:
+                proba = await batcher.score(batcher.scoring_model.to_row(request['record']))
+        except (AttributeError, KeyError, TypeError, ValueError) as err:
+            return '400 Bad Request', {'error': str(err)}
+        return '200 OK', {'model': batcher.scoring_model.name, 'proba': proba}
+
+# =========
+# BENCHMARK
+# =========
+
+async def post_json(reader, writer, path, payload):
+    '''
+    sends one keep-alive POST request and returns the decoded JSON answer
+    '''
+    data = json.dumps(payload).encode('utf-8')
+    writer.write('POST {} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+                 'Content-Length: {}\r\n\r\n'.format(path, len(data)).encode('latin-1') + data)
+    await writer.drain()
+    await reader.readline()
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return json.loads(await reader.readexactly(length))
+
+
+async def run_benchmark(host, port, records, n_requests=2000, concurrency=8):
+    '''
+    Sends n_requests single-record scoring requests from concurrency
+    keep-alive connections and returns latency percentiles (milliseconds)
+    and throughput
+    '''
+    latencies = []
+
+    async def client(count, offset):
+        reader, writer = await asyncio.open_connection(host, port)
+        for i in range(count):
+            record = records[(offset + i) % len(records)]
+            start = time.perf_counter()
+            await post_json(reader, writer, '/score', {'record': record})
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+
+    counts = [n_requests // concurrency + (i < n_requests % concurrency) for i in range(concurrency)]
+    start = time.perf_counter()
+    await asyncio.gather(*[client(count, i * 997) for i, count in enumerate(counts)])
+    elapsed = time.perf_counter() - start
+    millis = np.array(latencies) * 1000
+    return {'requests': len(latencies),
+            'concurrency': concurrency,
+            'p50_ms': float(np.percentile(millis, 50)),
+            'p90_ms': float(np.percentile(millis, 90)),
+            'p99_ms': float(np.percentile(millis, 99)),
+            'max_ms': float(millis.max()),
+            'requests_per_s': len(latencies) / elapsed}
+
+
+def get_benchmark_records(features, n=500):
+    '''
+    returns up to n raw survey records (original column names)
+    from the study files, for benchmarking
+    '''
+    import acquire
+    dfa, dfb = acquire.get_data()
+    df = acquire.merge_all([dfa, prepare.add_recid_column(dfb)])
+    recoders = prepare.get_feature_recoders(features)
+    columns = [raw for raw, steps in recoders.values()]
+    return [{col: int(value) for col, value in zip(columns, values)}
+            for values in df[columns].head(n).to_numpy()]
+
+
+async def benchmark(model_dirs, n_requests=2000, concurrency=8, max_batch=64, max_wait=0.002):
+    '''
+    starts a server on a free localhost port, benchmarks it and stops it
+    '''
+    server = ScoringServer(model_dirs, max_batch, max_wait)
+    host, port = await server.start('127.0.0.1', 0)
+    try:
+        scoring_model = server.models[server.default].scoring_model
+        records = get_benchmark_records(scoring_model.features)
+        return await run_benchmark(host, port, records, n_requests, concurrency)
+    finally:
+        await server.stop()
+
+# ==================================================
+# MAIN
+# ==================================================
+
+def clear():
+    os.system("cls" if os.name == "nt" else "clear")
+
+def main(argv=None):
+    """Main entry point for the script.
+
+    python serve.py serve MODEL_DIR [MODEL_DIR ...] [--host H] [--port P]
+    python serve.py bench MODEL_DIR [--requests N] [--concurrency C]
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description='Single-record reassault risk scoring.')
+    parser.add_argument('command', choices=['serve', 'bench'])
+    parser.add_argument('model_dirs', nargs='+', help='registry directories, e.g. models/log_reg-<key>')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch', type=int, default=64, help='most rows scored together')
+    parser.add_argument('--max-wait-ms', type=float, default=2.0, help='longest wait to fill a batch')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args(argv)
+    max_wait = args.max_wait_ms / 1000
+    if args.command == 'bench':
+        results = asyncio.run(benchmark(args.model_dirs, args.requests, args.concurrency,
+                                        args.max_batch, max_wait))
+        print(json.dumps(results, indent=2))
+        return 0
+
+    async def serve():
+        server = ScoringServer(args.model_dirs, args.max_batch, max_wait)
+        host, port = await server.start(args.host, args.port)
+        print('serving {} on http://{}:{}'.format(', '.join(server.models), host, port))
+        try:
+            await server.server.serve_forever()
+        finally:
+            await server.stop()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+__authors__ = ["Ednalyn C. De Dios", "Jesse Ruiz", "Matthew Capper"]
+__copyright__ = "Copyright 2023, Codeup Data Science"
+__credits__ = ["Maggie Guist", "Zach Gulde"]
+__license__ = "MIT"
+__version__ = "1.0.1"
+__maintainers__ = "Ednalyn C. De Dios"
+__email__ = "ednalyn.dedios@gmail.com"
+__status__ = "Prototype"
@@ -0,0 +1,17 @@
+'''
+Puts the repository root on sys.path and runs every test from it, since the
+modules are flat scripts reading data/ and models/ by relative path.
+'''
+
+import os
+import sys
+
+import pytest
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+
+@pytest.fixture(autouse=True)
+def repo_cwd(monkeypatch):
+    monkeypatch.chdir(REPO_PATH)
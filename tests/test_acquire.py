@@ -0,0 +1,61 @@
+'''
+The column cache must read back exactly what the csv holds, and faster.
+'''
+
+import time
+
+import pandas as pd
+import pytest
+
+import acquire
+
+# files checked against pd.read_csv: a wide survey table and the widest cached one
+TIMED_FILES = ['data02.csv', 'data15.csv']
+
+
+def best_time(func, repeat=15):
+    '''
+    returns the fastest of repeat calls of func, in seconds
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@pytest.fixture
+def cache_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(acquire, 'CACHE_PATH', str(tmp_path / 'cache') + '/')
+    return tmp_path
+
+
+@pytest.mark.parametrize('filename', TIMED_FILES)
+def test_cache_matches_csv(cache_path, filename):
+    expected = pd.read_csv(acquire.DATA_PATH + filename, low_memory=False)
+    pd.testing.assert_frame_equal(acquire.read_data(filename), expected)
+    pd.testing.assert_frame_equal(acquire.read_data(filename), expected)
+    columns = list(expected.columns[::5])
+    pd.testing.assert_frame_equal(acquire.read_data(filename, columns=columns),
+                                  expected[columns])
+
+
+@pytest.mark.parametrize('filename', TIMED_FILES)
+def test_cached_read_faster_than_csv(cache_path, filename):
+    acquire.read_data(filename)
+    cached = best_time(lambda: acquire.read_data(filename))
+    parsed = best_time(lambda: pd.read_csv(acquire.DATA_PATH + filename, low_memory=False))
+    assert cached < parsed
+
+
+@pytest.mark.parametrize('use_cache', [True, False])
+def test_blank_cells_stay_float(cache_path, monkeypatch, use_cache):
+    (cache_path / 'blank.csv').write_text('id,score,count\n1,3,40000\n2,,5\n3,7,\n')
+    monkeypatch.setattr(acquire, 'DATA_PATH', str(cache_path) + '/')
+    dtypes = {'id': 'int8', 'score': 'int8', 'count': 'int16'}
+    for _ in range(2):
+        df = acquire.read_data('blank.csv', dtypes=dtypes, use_cache=use_cache)
+        assert df.dtypes.astype(str).tolist() == ['int8', 'float64', 'float64']
+        assert df['score'].isna().tolist() == [False, True, False]
+        assert df['count'].tolist()[:2] == [40000, 5]
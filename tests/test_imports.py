@@ -0,0 +1,50 @@
+'''
+Import-time budget: model.py and explore.py import sklearn, scipy and the
+plotting libraries inside the functions that use them, so a worker that
+imports either module only pays for numpy and pandas.
+'''
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['sklearn', 'scipy', 'matplotlib', 'seaborn']
+# seconds a module may take to import on top of numpy and pandas
+IMPORT_BUDGET = 0.5
+
+PROBE = '''
+import json, sys, time
+import numpy, pandas
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds,
+                  'loaded': [name for name in {heavy!r} if name in sys.modules]}}))
+'''
+
+
+def import_in_subprocess(module):
+    '''
+    imports module in a fresh interpreter and returns the seconds it took
+    (beyond numpy and pandas) and the heavy modules it loaded
+    '''
+    code = PROBE.format(module=module, heavy=HEAVY_MODULES)
+    out = subprocess.run([sys.executable, '-c', code], cwd=REPO_PATH,
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize('module', ['model', 'explore'])
+def test_import_skips_heavy_modules(module):
+    result = import_in_subprocess(module)
+    assert result['loaded'] == []
+
+
+@pytest.mark.parametrize('module', ['model', 'explore'])
+def test_import_within_budget(module):
+    result = import_in_subprocess(module)
+    assert result['seconds'] < IMPORT_BUDGET
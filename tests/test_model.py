@@ -0,0 +1,55 @@
+'''
+Compiled evaluators must give exactly the probabilities of the sklearn
+models they were compiled from, before and after a save/load round trip.
+'''
+
+import numpy as np
+import pytest
+
+import model
+
+pytest.importorskip('sklearn')
+
+
+@pytest.fixture
+def fixture_data():
+    '''
+    a small three-class frame with missing values in every feature, so the
+    trees learn a missing-value direction (missing_go_to_left) at their splits
+    '''
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(600, 6))
+    y = (X[:, 0] + X[:, 1] > 0).astype(int) + (X[:, 2] > 1)
+    X[rng.random(X.shape) < 0.1] = np.nan
+    X_test = rng.normal(size=(400, 6))
+    X_test[rng.random(X_test.shape) < 0.1] = np.nan
+    return X, y, X_test
+
+
+def fit_models(X, y):
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.tree import DecisionTreeClassifier
+    return [DecisionTreeClassifier(max_depth=8, random_state=0).fit(X, y),
+            RandomForestClassifier(n_estimators=25, min_samples_leaf=3,
+                                   random_state=0).fit(X, y),
+            RandomForestClassifier(n_estimators=10, class_weight='balanced',
+                                   random_state=1).fit(X, y == 1)]
+
+
+def test_compiled_trees_match_sklearn(fixture_data):
+    X, y, X_test = fixture_data
+    for clf in fit_models(X, y):
+        evaluator = model.compile_model(clf)
+        np.testing.assert_array_equal(evaluator.classes_, clf.classes_)
+        np.testing.assert_array_equal(evaluator.predict_proba(X_test), clf.predict_proba(X_test))
+        np.testing.assert_array_equal(evaluator.predict_proba(X_test[:1]),
+                                      clf.predict_proba(X_test[:1]))
+
+
+def test_saved_trees_match_sklearn(fixture_data, tmp_path):
+    X, y, X_test = fixture_data
+    for i, clf in enumerate(fit_models(X, y)):
+        out_dir = model.save_compiled(model.compile_model(clf), str(tmp_path / str(i)))
+        loaded = model.load_compiled(out_dir)
+        assert isinstance(loaded.threshold, np.memmap)
+        np.testing.assert_array_equal(loaded.predict_proba(X_test), clf.predict_proba(X_test))
@@ -0,0 +1,123 @@
+'''
+The rule-driven recoding (RECODES_ALL / RECODES_RECID through apply_recode)
+must give exactly what the chained Series.replace calls it replaced gave.
+The old calls are kept below as the reference.
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import prepare
+
+ALL_SPECIAL = ['length_relationship', 'num_abusers', 'num_children', 'power_scale',
+               'harass_scale', 'id_age', 'age_disparity', 'children_not_partner']
+RECID_BINARY = ['gun_fired', 'anyone_high', 'safe_place', 'forced_illegal',
+                'life_danger', 'talk_about_it']
+
+
+def reference_nonvals_all(df):
+    '''
+    replace_nonvals_all before the recoding rules, one replace call at a time
+    '''
+    for col in df:
+        if col in ['CASEID', 'id']:
+            pass
+        elif col not in ALL_SPECIAL:
+            df[col] = df[col].replace([2, 3, 9, 555, 666, 777, 888, 999, 9999], 0)
+            df[col] = df[col].replace(4, 1)
+        if col == 'guns_in_home':
+            df[col] = df[col].replace([2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15], 1)
+        elif col == 'num_children':
+            df[col] = df[col].replace([2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12], 2)
+        elif col == 'num_abusers':
+            df[col] = df[col].replace([2, 3], 2)
+            df[col] = df[col].replace(9, 0)
+        elif col == 'beaten_while_pregnant':
+            df[col] = df[col].replace([2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12], 0)
+        elif col == 'age_disparity':
+            df[col] = df[col].replace([1, 999], 0)
+            df[col] = df[col].replace(2, 1)
+            df[col] = df[col].replace(3, 2)
+            df[col] = df[col].replace(4, -1)
+            df[col] = df[col].replace(5, -2)
+            df[col] = df[col].replace(6, -3)
+        elif col == 'power_scale':
+            df[col] = df[col].replace(999, 0)
+
+
+def reference_nonvals_recid(df):
+    '''
+    replace_nonvals_recid before the recoding rules, one replace call at a time
+    (the id column, which the old code also ran through the default
+    sentinel map, is left out of the comparison)
+    '''
+    for col in df:
+        if col in ['CASEID', 'id']:
+            pass
+        elif col in RECID_BINARY:
+            df[col] = df[col].replace([2, 888, 999, 9999], 0)
+        if col == 'order_protection':
+            df[col] = df[col].replace([2, 3, 999, 9999], 0)
+        elif col == 'left_or_not':
+            df[col] = df[col].replace([11, 12, 13, 14, 15, 16, 17, 18, 19], 1)
+            df[col] = df[col].replace([21, 22, 31, 32, 33, 41, 42, 43, 44, 45, 46, 99], 0)
+        elif col == 'medical_staff_helpful':
+            df[col] = df[col].replace([41, 7777, 99999, 9999], 0)
+        elif col == 'level_severity':
+            df[col] = df[col].replace(9, 0)
+        elif col not in ['CASEID', 'id']:
+            df[col] = df[col].replace([888, 99, 999, 9999], 0)
+
+
+def get_code_pool():
+    '''
+    every code the rules mention, small codes, negatives and large values
+    '''
+    rule_codes = [code for spec in (prepare.make_recode_spec_all(prepare.RENAME_ALL.values()),
+                                    prepare.make_recode_spec_recid(prepare.RENAME_RECID.values()))
+                  for steps in spec.values() for codes, value in steps for code in codes]
+    return np.unique(np.concatenate([rule_codes, np.arange(-5, 50),
+                                     [555, 666, 777, 888, 999, 7777, 9999, 99999]]))
+
+
+def make_frame(columns, dtype, seed):
+    '''
+    a random frame over columns drawing from the code pool and uniform
+    codes up to 99999; float frames get missing values
+    '''
+    rng = np.random.default_rng(seed)
+    pool = get_code_pool()
+    n = 400
+    data = {}
+    for col in columns:
+        values = np.where(rng.random(n) < 0.7, rng.choice(pool, n), rng.integers(-100, 100000, n))
+        if dtype == 'float':
+            values = values.astype(float)
+            values[rng.random(n) < 0.1] = np.nan
+        else:
+            values = values.astype(dtype)
+        data[col] = values
+    return pd.DataFrame(data)
+
+
+@pytest.mark.parametrize('dtype', ['int64', 'int32', 'float'])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_replace_nonvals_all_matches_chained_replace(dtype, seed):
+    columns = list(dict.fromkeys(prepare.RENAME_ALL.values()))
+    df = make_frame(columns, dtype, seed)
+    expected = df.copy()
+    reference_nonvals_all(expected)
+    prepare.replace_nonvals_all(df)
+    pd.testing.assert_frame_equal(df, expected)
+
+
+@pytest.mark.parametrize('dtype', ['int64', 'int32', 'float'])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_replace_nonvals_recid_matches_chained_replace(dtype, seed):
+    columns = [col for col in dict.fromkeys(prepare.RENAME_RECID.values()) if col != 'id']
+    df = make_frame(columns, dtype, seed)
+    expected = df.copy()
+    reference_nonvals_recid(expected)
+    prepare.replace_nonvals_recid(df)
+    pd.testing.assert_frame_equal(df, expected)